@@ -0,0 +1,299 @@
+""" ctosbench.py
+
+    Time the ctosdisk entry points on synthetic volumes of several sizes,
+    built with ctosgen. Examples:
+
+    # run everything, and keep the results as a baseline
+    ctosbench.py --save baseline.json
+
+    # after a change, compare against the baseline; exits with an error if
+    # anything failed or got more than 20% slower
+    ctosbench.py --baseline baseline.json
+
+    # just the hard disk sized volume, just CheckDisk and ReplaceContents
+    ctosbench.py --sizes hd CheckDisk ReplaceContents
+
+    Each benchmark runs in a process of its own, so that its peak memory can
+    be reported. It is repeated until it has run for --min-time seconds;
+    setting up (copying the image, finding the file) isn't timed.
+"""
+
+from __future__ import print_function
+
+from ctosdisk import *
+from ctosgen import GenerateVolume
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+# name -> (GenerateVolume arguments)
+SIZES = [
+    ("small", dict(cylinders=40, heads=2, sectors=9, dirs=2, filesPerDir=10, maxSize=4096)),
+    ("medium", dict(cylinders=80, heads=2, sectors=18, dirs=4, filesPerDir=40, maxSize=8192, fragmentation=0.3)),
+    ("hd", dict(cylinders=820, heads=4, sectors=18, dirs=20, filesPerDir=200, maxSize=262144, sizeDist="lognormal", fragmentation=0.3)),
+]
+
+def someFile(vol, seed=1):
+    """ (directory, name) of a file other than the system files """
+    names = [(m["dirNameStr"], e["name"]) for m in vol.mfd if m["dirNameStr"] != "Sys" for e in vol.ReadDir(m["dirNameStr"])]
+    return random.Random(seed).choice(names)
+
+def openVolume(fn):
+    return CtosVolume(OpenImage(fn))
+
+def copyVolume(fn):
+    return CtosVolume(bytearray(open(fn, "rb").read()))
+
+def setupFile(fn):
+    vol = openVolume(fn)
+    return (vol, someFile(vol))
+
+def setupMutable(fn):
+    vol = copyVolume(fn)
+    (dirName, fileName) = someFile(vol)
+    return (vol, dirName, vol.FindFile(dirName, fileName))
+
+def runOpen(fn):
+    return openVolume(fn).vhb
+
+def runReadDir(vol):
+    for mfdEntry in vol.mfd:
+        for dirEntry in vol.ReadDir(mfdEntry["dirNameStr"]):
+            dirEntry.fh
+
+def runFindFile(state):
+    (vol, (dirName, fileName)) = state
+    return vol.FindFile(dirName, fileName)
+
+def runReplace(state):
+    (vol, dirName, fh) = state
+    ReplaceContents(vol, fh, b"R" * (fh["cbFile"] + 4096))
+
+def runDelete(state):
+    (vol, dirName, fh) = state
+    Delete(vol, dirName, fh)
+
+def setupExtract(fn):
+    return (openVolume(fn), tempfile.mkdtemp())
+
+def runExtract(state):
+    (vol, destDir) = state
+    try:
+        for (i, fh) in enumerate(FileOrder(vol)):
+            f = open(os.path.join(destDir, "%d" % i), "wb")
+            try:
+                WriteContents(vol.data, fh, f)
+            finally:
+                f.close()
+    finally:
+        shutil.rmtree(destDir)
+
+def runHash(vol):
+    for fh in FileOrder(vol):
+        HashContents(vol.data, fh)
+
+def setupDiff(fn):
+    vol = setupMutable(fn)[0]
+    other = bytearray(vol.data)
+    for offs in range(0, len(other), 97*512):
+        other[offs] ^= 0xFF
+    return (vol.data, other)
+
+def runDiff(state):
+    return DiffPages(state[0], state[1])
+
+def runDefrag(vol):
+    Defrag(vol, fullCheck=False)
+
+def runCompact(vol):
+    vhb = vol.vhb
+    return Compact(vol, vhb["CylindersPerDisk"], vhb["TracksPerCylinder"], vhb["SectorsPerTrack"], vhb["BytesPerSector"])
+
+# name -> (setup, run). setup takes the image file name and its result is
+# passed to run; only run is timed.
+BENCHMARKS = [
+    ("open", (lambda fn: fn, runOpen)),
+    ("ReadMFD", (OpenImage, ReadMFD)),
+    ("ReadDir", (openVolume, runReadDir)),
+    ("FindFile", (setupFile, runFindFile)),
+    ("CheckDisk", (openVolume, CheckDisk)),
+    ("ReplaceContents", (setupMutable, runReplace)),
+    ("Delete", (setupMutable, runDelete)),
+    ("extractAll", (setupExtract, runExtract)),
+    ("HashContents", (openVolume, runHash)),
+    ("DiffPages", (setupDiff, runDiff)),
+    ("Defrag", (copyVolume, runDefrag)),
+    ("Compact", (openVolume, runCompact)),
+]
+
+def peakMemoryKB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes there, kilobytes everywhere else
+        peak = peak // 1024
+    return peak
+
+def runBenchmark(name, fn, minTime, queue):
+    (setup, run) = dict(BENCHMARKS)[name]
+    elapsed = 0.0
+    count = 0
+    while (count == 0) or (elapsed < minTime):
+        state = setup(fn)
+        startTime = time.time()
+        run(state)
+        elapsed += time.time() - startTime
+        count += 1
+    queue.put( (count / max(elapsed, 0.000001), peakMemoryKB()) )
+
+def measure(name, fn, minTime):
+    """ (ops/sec, peak KB) of one benchmark, run in a fresh process, or the
+        process's exit code if it died without a result
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=runBenchmark, args=(name, fn, minTime, queue))
+    p.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not p.is_alive():
+                # an exception, the OOM killer, a crash...
+                return p.exitcode
+    p.join()
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    _help = 'Compare against the results saved in this file'
+    parser.add_argument(
+        '--baseline', dest='baseline',
+        default="",
+        action="store",
+        type=str,
+        help=_help)
+
+    _help = 'Save the results to this file, to compare against later'
+    parser.add_argument(
+        '--save', dest='save',
+        default="",
+        action="store",
+        type=str,
+        help=_help)
+
+    _help = 'Volume sizes to run, separated by commas (default: %s)' % ",".join([size[0] for size in SIZES])
+    parser.add_argument(
+        '--sizes', dest='sizes',
+        default=",".join([size[0] for size in SIZES]),
+        action="store",
+        type=str,
+        help=_help)
+
+    _help = 'Seconds to repeat each benchmark for (default: 0.5)'
+    parser.add_argument(
+        '--min-time', dest='minTime',
+        default=0.5,
+        type=float,
+        help=_help)
+
+    _help = 'Slowdown against the baseline, in percent, that counts as a regression (default: 20)'
+    parser.add_argument(
+        '--tolerance', dest='tolerance',
+        default=20.0,
+        type=float,
+        help=_help)
+
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run (default: all)")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    sizes = dict(SIZES)
+    for size in args.sizes.split(","):
+        if size not in sizes:
+            print("Error: unknown size %s" % size, file=sys.stderr)
+            sys.exit(-1)
+    names = args.benchmarks or [benchmark[0] for benchmark in BENCHMARKS]
+    for name in names:
+        if name not in dict(BENCHMARKS):
+            print("Error: unknown benchmark %s" % name, file=sys.stderr)
+            sys.exit(-1)
+
+    baseline = {}
+    if args.baseline:
+        baseline = json.load(open(args.baseline, "r"))["results"]
+
+    results = {}
+    regressions = 0
+    failures = 0
+    tempDir = tempfile.mkdtemp()
+    try:
+        print("%-8s %-16s %12s %10s %12s %8s" % ("SIZE", "BENCHMARK", "OPS/SEC", "PEAK KB", "BASELINE", "CHANGE"))
+        for size in args.sizes.split(","):
+            fn = os.path.join(tempDir, "%s.img" % size)
+            f = open(fn, "wb")
+            try:
+                f.write(GenerateVolume(**sizes[size]))
+            finally:
+                f.close()
+
+            for name in names:
+                key = "%s/%s" % (size, name)
+                result = measure(name, fn, args.minTime)
+                if not isinstance(result, tuple):
+                    print("%-8s %-16s FAILED (exit code %s)" % (size, name, result))
+                    sys.stdout.flush()
+                    failures += 1
+                    continue
+                (ops, peak) = result
+                results[key] = {"ops": ops, "peakKB": peak}
+
+                line = "%-8s %-16s %12.2f %10s" % (size, name, ops, peak if peak is not None else "-")
+                if key in baseline:
+                    change = (ops / baseline[key]["ops"] - 1.0) * 100.0
+                    line += " %12.2f %+7.1f%%" % (baseline[key]["ops"], change)
+                    if change < -args.tolerance:
+                        line += " SLOWER"
+                        regressions += 1
+                print(line)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tempDir)
+
+    if args.save:
+        f = open(args.save, "w")
+        try:
+            json.dump({"python": platform.python_version(), "minTime": args.minTime, "results": results}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if failures > 0:
+        print("Error: %d benchmarks failed" % failures, file=sys.stderr)
+    if regressions > 0:
+        print("Error: %d benchmarks are more than %d%% slower than the baseline" % (regressions, args.tolerance), file=sys.stderr)
+    if (failures > 0) or (regressions > 0):
+        sys.exit(-1)
+
+if __name__ == "__main__":
+    main()
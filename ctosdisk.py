@@ -10,8 +10,15 @@ For the actual command-line tool, see ctostool.py
 
 from __future__ import print_function
 
+import array
+import binascii
+import bisect
+import hashlib
 import math
+import mmap
+import operator
 import os, struct
+import re
 import sys
 import itertools
 import unicodedata
@@ -143,10 +150,65 @@ def escape(my_string):
 
 def byteArraySliceToString(ba, start, end):
     result = ""
-    for b in ba[start:end]:
+    for b in bytearray(ba[start:end]):
         result = result + chr(b)
     return result
 
+BYTE = struct.Struct("<B")
+
+def ReadByte(data, offs):
+    # data[offs] is an int for a bytearray but a str for a python 2 mmap
+    return BYTE.unpack_from(data, offs)[0]
+
+def OpenImage(fn, copyOnWrite=False):
+    """ Map an image file into memory. Nothing is read until a structure is
+        decoded from it. With copyOnWrite, modifications stay private to this
+        process until they are explicitly saved.
+    """
+    f = open(fn, "rb")
+    try:
+        try:
+            if copyOnWrite:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty files, or filesystems that can't be mapped
+            return bytearray(f.read())
+    finally:
+        f.close()
+
+def PWrite(fd, chunk, offset):
+    """ write all of chunk at offset, without moving the file position where
+        os.pwrite exists, or by seeking first where it doesn't
+    """
+    done = 0
+    while done < len(chunk):
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, chunk[done:], offset + done)
+        else:
+            os.lseek(fd, offset + done, os.SEEK_SET)
+            n = os.write(fd, chunk[done:])
+        done += n
+    return done
+
+def WritePages(fn, data, runs, sync=False):
+    """ Write (start page, count) runs of data to the same place in the file
+        fn, leaving the rest of the file alone, and fsync it if sync is set.
+        Returns the number of bytes written.
+    """
+    fd = os.open(fn, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        written = 0
+        for (start, count) in runs:
+            offset = start * PAGE_SIZE
+            written += PWrite(fd, bytes(data[offset:offset + count*PAGE_SIZE]), offset)
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    return written
+
 def SanityCheck(st):
     offs = 0
     for field in st:
@@ -162,62 +224,169 @@ def SanityCheckAll():
     SanityCheck(FILE_HEADER_FIELDS)
     SanityCheck(BAD_BLOCK_FIELDS)
 
-def FieldToSpec(field):
+def FieldToFormat(field):
     if field[1] == 1:
-        spec = "<B"
+        return "B"
     elif field[1] == 2:
-        spec = "<H"
+        return "H"
     elif field[1] == 4:
-        spec = "<L"
+        return "L"
     else:
-        spec = "%ds" % field[1]
-    return spec
+        return "%ds" % field[1]
 
-def DecodeStructAsList(data, st):
-    result = []
-    offs = 0
-    for field in st:
-        spec = FieldToSpec(field)
-        result.append( (field[2], struct.unpack_from(spec, data, offs)[0]) )
-        offs = offs + field[1]
+def FieldToSpec(field):
+    return "<" + FieldToFormat(field)
+
+class Record(object):
+    """ A decoded structure. Fields may be read as attributes, or by name as
+        with the dicts the decoders used to return.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def copy(self):
+        result = self.__class__.__new__(self.__class__)
+        for (name, value) in self.items():
+            setattr(result, name, value)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(["%s=%r" % item for item in self.items()]))
+
+class StructCodec(object):
+    """ A field table (list of (offset, size, name) tuples) compiled into a
+        single struct.Struct. Decoding yields a Record with one slot per field,
+        plus any extra slots the caller asks for to hang derived values on.
+    """
+    def __init__(self, st, name="Record", extras=()):
+        self.st = st
+        self.names = tuple([field[2] for field in st])
+
+        fmt = "<"
+        offs = 0
+        for field in st:
+            if field[0] > offs:
+                fmt += "%dx" % (field[0] - offs)
+            fmt += FieldToFormat(field)
+            offs = field[0] + field[1]
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.record = type(name, (Record,), {"__slots__": self.names + tuple(extras)})
+        self.attrGetter = operator.attrgetter(*self.names)
+        self.itemGetter = operator.itemgetter(*self.names)
+
+    def unpack_from(self, data, offset=0):
+        rec = self.record.__new__(self.record)
+        for (name, value) in zip(self.names, self.struct.unpack_from(data, offset)):
+            setattr(rec, name, value)
+        return rec
+
+    def unpack_values(self, data, offset=0):
+        return self.struct.unpack_from(data, offset)
+
+    def pack_into(self, src, dest, offset=0):
+        if isinstance(src, Record):
+            values = self.attrGetter(src)
+        else:
+            values = self.itemGetter(src)
+        self.struct.pack_into(dest, offset, *values)
+        return dest
 
-    return result
+VHB_CODEC = StructCodec(VHB_FIELDS, "VHB")
+MFD_CODEC = StructCodec(MFD_FIELDS, "MfdEntry", ["dirNameStr", "dirPassStr"])
+FILE_HEADER_CODEC = StructCodec(FILE_HEADER_FIELDS, "FileHeader", ["nameStr", "vhb", "extents", "fho", "offset"])
 
-def DecodeStructAsDict(data, st):
-    resultList = DecodeStructAsList(data, st)
-    result = {}
-    for item in resultList:
-        result[item[0]] = item[1]
-    return result
+codecCache = {}
+for codec in [VHB_CODEC, MFD_CODEC, FILE_HEADER_CODEC]:
+    codecCache[id(codec.st)] = codec
 
-def EncodeStruct(src, dest, st, offset=0):
-    #dest = dest.encode("utf-8")
-    for field in st:
-        (offs, size, name) = field
-        v = src[name]
-        spec = FieldToSpec(field)
-        struct.pack_into(spec, dest, offs + offset, v)
+def GetCodec(st):
+    codec = codecCache.get(id(st))
+    if (codec is None) or (codec.st is not st):
+        codec = StructCodec(st)
+        codecCache[id(st)] = codec
+    return codec
 
-    return dest
+def DecodeStructAsList(data, st, offset=0):
+    codec = GetCodec(st)
+    return list(zip(codec.names, codec.unpack_values(data, offset)))
 
-def PrintStruct(data, st):
-    fields = DecodeStructAsList(data, st)
+def DecodeStructAsDict(data, st, offset=0):
+    codec = GetCodec(st)
+    return dict(zip(codec.names, codec.unpack_values(data, offset)))
+
+def EncodeStruct(src, dest, st, offset=0):
+    return GetCodec(st).pack_into(src, dest, offset)
+
+def PrintStruct(data, st, offset=0):
+    fields = DecodeStructAsList(data, st, offset)
     for field in fields:
         print("%20s %s" % (field[0], escape(str(field[1]))))
 
-def ComputeVHBChecksum(data):
-    w = 0x7C39
-    for i in range(127):
-        w = w - struct.unpack_from("<H", data, 2*i+2)[0]
-    return (w & 0xFFFF)
+def SumWords(data, offset, nWords):
+    """ sum, modulo 0x10000, of nWords little-endian words at offset """
+    return sum(struct.unpack_from("<%dH" % nWords, data, offset)) & 0xFFFF
+
+def WordArray(data, offset, nWords):
+    """ nWords little-endian words at offset as an array('H') """
+    words = array.array("H")
+    raw = bytes(data[offset:offset + 2*nWords])
+    if hasattr(words, "frombytes"):
+        words.frombytes(raw)
+    else:
+        words.fromstring(raw)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+def ComputeVHBChecksum(data, offset=0):
+    return (0x7C39 - SumWords(data, offset+2, 127)) & 0xFFFF
+
+VHB_FIELD_MAP = dict([(field[2], field) for field in VHB_FIELDS])
+
+def UpdateVHBFields(data, offset, values):
+    """ Change individual fields of the VHB at offset and fix up its checksum,
+        leaving every other field exactly as it is on disk.
+    """
+    for (name, value) in values.items():
+        field = VHB_FIELD_MAP[name]
+        struct.pack_into(FieldToSpec(field), data, offset + field[0], value)
+    struct.pack_into("<H", data, offset, ComputeVHBChecksum(data, offset))
 
 cpdwarn = False
 
 def LoadVHB(data, which="active"):
-    d = DecodeStructAsDict(data, VHB_FIELDS)
+    d = VHB_CODEC.unpack_from(data)
     if which == "backup":
         return d
-    d = DecodeStructAsDict(data[d["LfaVHB"]:], VHB_FIELDS)
+    d = VHB_CODEC.unpack_from(data, d["LfaVHB"])
     if d["CylindersPerDisk"] == 2:
         # my AWS formatted the disk like this??
         global cpdwarn
@@ -227,21 +396,70 @@ def LoadVHB(data, which="active"):
         d["CylindersPerDisk"] = 77
     return d
 
-def VerifyVHBChecksum(data, which="backup"):
-    d = DecodeStructAsDict(data, VHB_FIELDS)
-    w = ComputeVHBChecksum(data)
+def VerifyVHBChecksum(data, which="backup", offset=0):
+    d = VHB_CODEC.unpack_from(data, offset)
+    w = ComputeVHBChecksum(data, offset)
     if d["Checksum"] != w:
         print("Checksum mismatch in %s VHD %X != %X" % (which, d["Checksum"], w), file=sys.stderr)
 
 def VerifyActiveVHB(data):
-    vhb = DecodeStructAsDict(data, VHB_FIELDS)
-    vhb2 = DecodeStructAsDict(data[vhb["LfaVHB"]:], VHB_FIELDS)
-    VerifyVHBChecksum(data[vhb["LfaVHB"]:], "active")
+    vhb = VHB_CODEC.unpack_from(data)
+    vhb2 = VHB_CODEC.unpack_from(data, vhb["LfaVHB"])
+    VerifyVHBChecksum(data, "active", vhb["LfaVHB"])
 
     for (k, v) in vhb.items():
         if vhb2[k] != v:
             print("Active/Backup VHB Mismatch (field=%s, backup=%s, active=%s)" % (k, escape(str(v)), escape(str(vhb2[k]))), file=sys.stderr)
 
+def IsCtosVolume(data):
+    """ True if data starts with a VHB whose checksum is good and whose
+        active VHB lies inside the image. Cheap enough to run on every file
+        in a directory tree, to pick out the volume images.
+    """
+    if len(data) < PAGE_SIZE:
+        return False
+    if struct.unpack_from("<H", data, 0)[0] != ComputeVHBChecksum(data):
+        return False
+    lfaVhb = struct.unpack_from("<L", data, VHB_FIELD_MAP["LfaVHB"][0])[0]
+    return lfaVhb + PAGE_SIZE <= len(data)
+
+# MFD, directory and file header pages are 512 bytes whatever the sector size
+PAGE_SIZE = 512
+MFD_ENTRIES_PER_PAGE = 14
+MFD_ENTRY_SIZE = 35
+
+def CtosNameHash(name, nPages):
+    """ The home page of a name in a directory, or in the MFD, of nPages
+        pages: the sum of the name's characters, folded to upper case, modulo
+        the number of pages.
+    """
+    if nPages <= 0:
+        return 0
+    return sum([ord(c) for c in name.upper()]) % nPages
+
+def ProbePages(name, nPages):
+    """ Page numbers in the order CTOS searches them for a name: the home
+        page, then each following page, wrapping around. Entries that don't
+        fit in their home page overflow into the next page with room.
+    """
+    home = CtosNameHash(name, nPages)
+    return [(home + i) % nPages for i in range(nPages)]
+
+def DecodeMfdEntry(data, offs):
+    # an empty slot has a zero length name; don't bother decoding the rest
+    if ReadByte(data, offs) == 0:
+        return None
+
+    mfdEntry = MFD_CODEC.unpack_from(data, offs)
+
+    dirNameLen = ord(mfdEntry["DirectoryName"][0])
+    mfdEntry["dirNameStr"] = mfdEntry["DirectoryName"][1:dirNameLen+1]
+
+    dirPassLen = ord(mfdEntry["DirPassword"][0])
+    mfdEntry["dirPassStr"] = mfdEntry["DirPassword"][1:dirPassLen+1]
+
+    return mfdEntry
+
 def ReadMFD(data, vhb=None):
     if not vhb:
         vhb = LoadVHB(data)
@@ -251,21 +469,14 @@ def ReadMFD(data, vhb=None):
     blkoffs = offs
     for i in range(vhb["CPagedMFD"]):
         offs = blkoffs + 1 # skip the header
-        for j in range(14):
-            mfdEntry = DecodeStructAsDict(data[offs:], MFD_FIELDS) 
-
-            dirNameLen = ord(mfdEntry["DirectoryName"][0])
-            mfdEntry["dirNameStr"] = mfdEntry["DirectoryName"][1:dirNameLen+1]
-
-            dirPassLen = ord(mfdEntry["DirPassword"][0])
-            mfdEntry["dirPassStr"] = mfdEntry["DirPassword"][1:dirPassLen+1]
-
-            if (dirNameLen > 0):
+        for j in range(MFD_ENTRIES_PER_PAGE):
+            mfdEntry = DecodeMfdEntry(data, offs)
+            if mfdEntry is not None:
                 entries.append(mfdEntry)
 
-            offs = offs + 35
+            offs = offs + MFD_ENTRY_SIZE
 
-        blkoffs = blkoffs + vhb["BytesPerSector"]
+        blkoffs = blkoffs + PAGE_SIZE
 
     return entries
 
@@ -275,12 +486,27 @@ def FindMfd(mfd, name):
             return mfdEntry
     return None
 
+def FindMfdHashed(data, name, vhb):
+    """ Find a directory's MFD entry by probing from its home MFD page,
+        comparing names before decoding anything else.
+    """
+    key = name.lower()
+    for page in ProbePages(name, vhb["CPagedMFD"]):
+        offs = vhb["LfaMFDbase"] + page*PAGE_SIZE + 1
+        for j in range(MFD_ENTRIES_PER_PAGE):
+            nameLen = ReadByte(data, offs)
+            if (nameLen > 0) and (byteArraySliceToString(data, offs+1, offs+1+nameLen).lower() == key):
+                return DecodeMfdEntry(data, offs)
+            offs = offs + MFD_ENTRY_SIZE
+    return None
+
 def PrintMfd(mfd):
     for mfdEntry in mfd:
         print("%-13s %-13s %d (%d pages)" % (mfdEntry["dirNameStr"], mfdEntry["dirPassStr"], mfdEntry["LfaDirbase"], mfdEntry["CPages"]))
 
-def ReadFileHeader(data, fho):
-    vhb = LoadVHB(data)
+def ReadFileHeader(data, fho, vhb=None):
+    if not vhb:
+        vhb = LoadVHB(data)
     offset = vhb["LfaFileHeadersbase"] + fho*512
 
     if offset>len(data):
@@ -289,7 +515,7 @@ def ReadFileHeader(data, fho):
         print("ERROR: File header offset %d out of range (file header number %d)" % (offset, fho), file=sys.stderr)
         return None
 
-    fh = DecodeStructAsDict(data[offset:], FILE_HEADER_FIELDS)
+    fh = FILE_HEADER_CODEC.unpack_from(data, offset)
 
     nameLen = ord(fh["sbFileName"][0])
     name = fh["sbFileName"][1:nameLen+1]
@@ -312,6 +538,65 @@ def ReadFileHeader(data, fho):
 
     return fh
 
+class FileHeaderTable(object):
+    """ The file header region decoded in one pass into columns, one entry
+        per header number: nameLen, FileHeaderNumber, cbFile and iFreeRun,
+        plus the extent arrays of each header.
+    """
+
+    # the columns of one 512 byte header, everything else skipped
+    ROW = "4xB76xH28xL4xH32L32L135x"
+    WIDTH = 4 + 32 + 32
+
+    def __init__(self, data, vhb):
+        base = vhb["LfaFileHeadersbase"]
+        self.count = max(0, min(vhb["CPagesFilesHeaders"], (len(data) - base) // 512))
+        self.values = struct.unpack_from("<" + self.ROW*self.count, data, base)
+
+        self.nameLen = self.values[0::self.WIDTH]
+        self.FileHeaderNumber = self.values[1::self.WIDTH]
+        self.cbFile = self.values[2::self.WIDTH]
+        self.iFreeRun = self.values[3::self.WIDTH]
+
+    def __len__(self):
+        return self.count
+
+    def LfaExtents(self, fho):
+        start = fho*self.WIDTH + 4
+        return self.values[start:start + min(self.iFreeRun[fho], 32)]
+
+    def CbExtents(self, fho):
+        start = fho*self.WIDTH + 4 + 32
+        return self.values[start:start + min(self.iFreeRun[fho], 32)]
+
+    def Extents(self, fho):
+        """ (lfa, length) of each extent, like fh["extents"] """
+        return [extent for extent in zip(self.LfaExtents(fho), self.CbExtents(fho)) if extent[0] != 0]
+
+    def InUse(self):
+        """ numbers of the headers that hold a name """
+        return [fho for (fho, nameLen) in enumerate(self.nameLen) if nameLen != 0]
+
+    def Primaries(self):
+        """ numbers of the in-use headers that are not alternates """
+        fhns = self.FileHeaderNumber
+        return [fho for fho in self.InUse() if fhns[fho] == fho]
+
+    def Alternate(self, fho, altOffset):
+        """ number of the alternate of header fho, or None if it has none """
+        secondaryFho = fho + altOffset
+        if (altOffset > 0) and (secondaryFho < self.count) and (self.FileHeaderNumber[secondaryFho] == self.FileHeaderNumber[fho]):
+            return secondaryFho
+        return None
+
+    def Usage(self):
+        """ (headers in use, files, bytes, extents) """
+        primaries = self.Primaries()
+        return (len(self.InUse()),
+                len(primaries),
+                sum([self.cbFile[fho] for fho in primaries]),
+                sum([min(self.iFreeRun[fho], 32) for fho in primaries]))
+
 def EncodeExtents(fh):
     # clear existing extents
     lfas = bytearray(fh["rgLfaExtents"])
@@ -351,21 +636,21 @@ def ReadDirOld(data, name, vhb=None, mfd=None):
     entries = []
     offs = mfdEntry["LfaDirbase"]
 
-    lastOffs = offs + mfdEntry["CPages"] * vhb["BytesPerSector"]
+    lastOffs = offs + mfdEntry["CPages"] * PAGE_SIZE
 
     while offs < lastOffs:
-        if data[offs] == 0x00:
+        if ReadByte(data, offs) == 0x00:
             offs += 1
             continue
 
-        if data[offs] == 0xFF:
+        if ReadByte(data, offs) == 0xFF:
             # not sure what FF is for, but found it in the OS dir of my copy1 image
             offs += 1
             continue
 
-        nameLen = data[offs]
+        nameLen = ReadByte(data, offs)
         offs += 1
-        name = data[offs:offs+nameLen]
+        name = byteArraySliceToString(data,offs,offs+nameLen)
         offs += nameLen
         fho = struct.unpack_from("<H", data, offs)[0]
         offs += 2
@@ -381,6 +666,75 @@ def ReadDirOld(data, name, vhb=None, mfd=None):
 
     return entries
 
+def ReadDirPageNames(data, pageOffs, vhb):
+    """ Yield (name, file header number, entry offset) for each entry in one
+        directory page
+    """
+    # dir entries always start after the first byte
+    offs = pageOffs + 1
+    # lastOffs is the end of this page
+    lastOffs = pageOffs + PAGE_SIZE
+    while offs < lastOffs:
+        if ReadByte(data, offs) == 0x00:
+            break
+
+        entryOffs = offs
+        nameLen = ReadByte(data, offs)
+        offs += 1
+        name = byteArraySliceToString(data,offs,offs+nameLen)
+        offs += nameLen
+        fho = struct.unpack_from("<H", data, offs)[0]
+        offs += 2
+
+        yield (name, fho, entryOffs)
+
+def ReadDirNames(data, mfdEntry, vhb):
+    """ Yield (name, file header number, entry offset) for each entry in a
+        directory
+    """
+    pageOffs = mfdEntry["LfaDirbase"]
+
+    for i in range(0, mfdEntry["CPages"]):
+        for entry in ReadDirPageNames(data, pageOffs, vhb):
+            yield entry
+
+        # point to the next page offset
+        pageOffs = pageOffs + PAGE_SIZE
+
+class DirEntry(object):
+    """ One directory entry: the name and file header number from the
+        directory page, and the slot (byte offset) it was read from. The file
+        header is only read, through readFileHeader, the first time fh is
+        used, so listing names or looking one up never touches the headers.
+    """
+    __slots__ = ("name", "offset", "slot", "readFileHeader", "_fh")
+
+    def __init__(self, name, fho, slot, readFileHeader):
+        self.name = name
+        self.offset = fho
+        self.slot = slot
+        self.readFileHeader = readFileHeader
+        self._fh = None
+
+    @property
+    def fh(self):
+        if self.readFileHeader is not None:
+            fh = self.readFileHeader(self.offset)
+            self.readFileHeader = None
+            if (fh is not None) and (fh["nameStr"] != self.name):
+                print("File header name mismatch %s != %s" % (self.name, fh["nameStr"]), file=sys.stderr)
+            self._fh = fh
+        return self._fh
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+def MakeDirEntries(names, readFileHeader):
+    return [DirEntry(name, fho, entryOffs, readFileHeader) for (name, fho, entryOffs) in names]
+
 def ReadDir(data, name, vhb=None, mfd=None):
     if not vhb:
         vhb = LoadVHB(data)
@@ -392,95 +746,84 @@ def ReadDir(data, name, vhb=None, mfd=None):
         print("Failed to find %s in mfd" % name, file=sys.stderr)
         return []
 
-    entries = []
-    pageOffs = mfdEntry["LfaDirbase"]
-
-    for i in range(0, mfdEntry["CPages"]):
-        # dir entries always start after the first byte
-        offs = pageOffs + 1
-        # lastOffs is the end of this page
-        lastOffs = offs + vhb["BytesPerSector"]
-        while offs < lastOffs:
-            if data[offs] == 0x00:
-                break
-
-            nameLen = data[offs]
-            offs += 1
-            name = byteArraySliceToString(data,offs,offs+nameLen)
-            offs += nameLen
-            fho = struct.unpack_from("<H", data, offs)[0]
-            offs += 2
-
-            fh = ReadFileHeader(data, fho)
-            if fh is None:
-                continue
-
-            if fh["nameStr"] != name:
-                print("File header name mismatch %s != %s" % (name, fh["nameStr"]), file=sys.stderr)
-
-            entries.append( {"name": name, "offset": fho, "fh": fh} )
-
-        # point to the next page offset
-        pageOffs = pageOffs + vhb["BytesPerSector"]
+    return MakeDirEntries(ReadDirNames(data, mfdEntry, vhb), lambda fho: ReadFileHeader(data, fho, vhb))
+
+def FindDirEntryHashed(data, mfdEntry, vhb, name):
+    """ Find a name in a directory by probing from its home page. Returns
+        (name, file header number, entry offset), or None.
+    """
+    key = name.lower()
+    for page in ProbePages(name, mfdEntry["CPages"]):
+        pageOffs = mfdEntry["LfaDirbase"] + page*PAGE_SIZE
+        for entry in ReadDirPageNames(data, pageOffs, vhb):
+            if entry[0].lower() == key:
+                return entry
+    return None
 
-    return entries
+def DirPageOffset(mfdEntry, vhb, entryOffs):
+    """ offset of the directory page holding the entry at entryOffs """
+    return mfdEntry["LfaDirbase"] + ((entryOffs - mfdEntry["LfaDirbase"]) // PAGE_SIZE) * PAGE_SIZE
+
+def AddDirEntry(data, mfdEntry, vhb, name, fho):
+    """ Add an entry to the first page, in probe order from the name's home
+        page, that has room for it. Returns the offset of the page, or None
+        if the directory is full.
+    """
+    entrySize = 1 + len(name) + 2
+    for page in ProbePages(name, mfdEntry["CPages"]):
+        pageOffs = mfdEntry["LfaDirbase"] + page*PAGE_SIZE
+        end = pageOffs + 1
+        for (entryName, entryFho, entryOffs) in ReadDirPageNames(data, pageOffs, vhb):
+            end = entryOffs + 1 + len(entryName) + 2
+        # leave at least one zero byte to terminate the page
+        if end + entrySize < pageOffs + PAGE_SIZE:
+            struct.pack_into("<B%dsH" % len(name), data, end, len(name), name, fho)
+            return pageOffs
+    return None
 
-def RemoveDirEntry(data, directory, nameToDelete, vhb=None, mfd=None):
+def RemoveDirEntry(data, directory, nameToDelete, vhb=None, mfd=None, mfdEntry=None):
     if not vhb:
         vhb = LoadVHB(data)
-    if not mfd:
-        mfd = ReadMFD(data, vhb=vhb)
-
-    mfdEntry = FindMfd(mfd, directory)
     if not mfdEntry:
-        print("Failed to find %s in mfd" % name, file=sys.stderr)
+        if not mfd:
+            mfd = ReadMFD(data, vhb=vhb)
+        mfdEntry = FindMfd(mfd, directory)
+    if not mfdEntry:
+        print("Failed to find %s in mfd" % directory, file=sys.stderr)
         return []
 
-    pageOffs = mfdEntry["LfaDirbase"]
+    entry = FindDirEntryHashed(data, mfdEntry, vhb, nameToDelete)
+    if entry is None:
+        return []
 
-    for i in range(0, mfdEntry["CPages"]):
-        # dir entries always start after the first byte
-        offs = pageOffs + 1
-        # lastOffs is the end of this page
-        lastOffs = offs + vhb["BytesPerSector"]
-        while offs < lastOffs:
-            if data[offs] == 0x00:
-                break
-
-            nameLen = data[offs]
-            offs += 1
-            name = byteArraySliceToString(data,offs,offs+nameLen)
-            offs += nameLen
-            fho = struct.unpack_from("<H", data, offs)[0]
-            offs += 2
-
-            if name == nameToDelete:
-                # shift remaining entries up
-                entrySize = 1 + nameLen + 2
-                nextEntryOffs = offs
-                while nextEntryOffs < lastOffs:
-                    data[offs - entrySize] = data[nextEntryOffs]
-                    offs += 1
-                    nextEntryOffs += 1
-                # zero out the remaining bytes at the end
-                for j in range(offs - entrySize, lastOffs):
-                    data[j] = 0x00
-                # done with this page
-                break
+    # returns the offsets of the pages that were edited
+    (name, fho, entryOffs) = entry
+    pageOffs = DirPageOffset(mfdEntry, vhb, entryOffs)
+    lastOffs = pageOffs + PAGE_SIZE
 
-        # point to the next page offset
-        pageOffs = pageOffs + vhb["BytesPerSector"]
+    # shift remaining entries up
+    entrySize = 1 + len(name) + 2
+    data[entryOffs:lastOffs - entrySize] = data[entryOffs + entrySize:lastOffs]
+    # zero out the remaining bytes at the end
+    data[lastOffs - entrySize:lastOffs] = b"\x00" * entrySize
 
-    return 
+    return [pageOffs]
 
 def PrintDir(dirEntries):
     print("%-20s %4s %8s %s" % ("NAME", "OFFS", "SIZE", "EXTENTS"))
     for dirEntry in dirEntries:
-        print("%-20s %4d %8d" % (escape(dirEntry["name"]), dirEntry["offset"], dirEntry["fh"]["cbFile"]), end="")
-        for extent in dirEntry["fh"]["extents"]:
+        fh = dirEntry.fh
+        if fh is None:
+            continue
+        print("%-20s %4d %8d" % (escape(dirEntry.name), dirEntry.offset, fh["cbFile"]), end="")
+        for extent in fh["extents"]:
             print(" <offs %d, len %d>" % (extent[0], extent[1]), end="")
         print("")
 
+def PrintDirNames(dirEntries):
+    for dirEntry in dirEntries:
+        print(escape(dirEntry.name))
+
 
 def FindFile(dirEntries, name):
     for dirEntry in dirEntries:
@@ -493,187 +836,725 @@ def BitmapSize(vhb):
     bitmapSize = int(math.ceil(nSectors/8.0))
     return bitmapSize
 
-def ReadAllocationBitmap(data):
+def BitmapSectors(vhb):
+    bitmapSectors = int(math.ceil(BitmapSize(vhb)/512.0))
+    if BitmapSize(vhb) % 512 == 0:
+        # possible bug? Noticed one additional page if bitmap consumed the entire last sector
+        bitmapSectors += 1
+    return bitmapSectors
+
+ANY_FREE = re.compile(b"[^\x00]")
+ANY_ALLOCATED = re.compile(b"[^\xff]")
+
+class AllocationBitmap(object):
+    """ The allocation bitmap, kept packed the way it is stored on disk: one
+        bit per sector, least significant bit first, 1 = free, 0 = allocated.
+
+        Indexing by sector number works as it did for the old list of ints.
+        Range operations work a byte at a time, and searches skip over fully
+        allocated or fully free bytes with a regex. Only the bytes that have
+        changed are written back.
+    """
+    def __init__(self, bits, nSectors, offset=0):
+        self.bits = bytearray(bits)
+        self.nSectors = nSectors
+        self.offset = offset
+        self.dirtyLo = None
+        self.dirtyHi = None
+
+    def __len__(self):
+        return self.nSectors
+
+    def __getitem__(self, sector):
+        if (sector < 0) or (sector >= self.nSectors):
+            raise IndexError("sector %d out of range" % sector)
+        return (self.bits[sector >> 3] >> (sector & 7)) & 1
+
+    def __setitem__(self, sector, value):
+        if (sector < 0) or (sector >= self.nSectors):
+            raise IndexError("sector %d out of range" % sector)
+        if value:
+            self.bits[sector >> 3] |= (1 << (sector & 7))
+        else:
+            self.bits[sector >> 3] &= ~(1 << (sector & 7)) & 0xFF
+        self.Touch(sector >> 3, (sector >> 3) + 1)
+
+    def __iter__(self):
+        for sector in range(self.nSectors):
+            yield (self.bits[sector >> 3] >> (sector & 7)) & 1
+
+    def Touch(self, lo, hi):
+        if self.dirtyLo is None:
+            (self.dirtyLo, self.dirtyHi) = (lo, hi)
+        else:
+            self.dirtyLo = min(self.dirtyLo, lo)
+            self.dirtyHi = max(self.dirtyHi, hi)
+
+    def CountFree(self, start=0, end=None):
+        if end is None:
+            end = self.nSectors
+        count = 0
+        # partial bytes at either end are counted a bit at a time
+        while (start < end) and (start & 7):
+            count += self[start]
+            start += 1
+        while (end > start) and (end & 7):
+            end -= 1
+            count += self[end]
+        if end > start:
+            count += bin(int(b"0" + binascii.hexlify(bytes(self.bits[start >> 3:end >> 3])), 16)).count("1")
+        return count
+
+    def SetRange(self, start, count, value):
+        end = start + count
+        if (start < 0) or (end > self.nSectors):
+            raise IndexError("sectors %d-%d out of range" % (start, end))
+        while (start < end) and (start & 7):
+            self[start] = value
+            start += 1
+        nBytes = (end - start) >> 3
+        if nBytes > 0:
+            lo = start >> 3
+            if value:
+                self.bits[lo:lo+nBytes] = b"\xff" * nBytes
+            else:
+                self.bits[lo:lo+nBytes] = b"\x00" * nBytes
+            self.Touch(lo, lo+nBytes)
+            start += nBytes * 8
+        while start < end:
+            self[start] = value
+            start += 1
+
+    def Free(self, start, count):
+        self.SetRange(start, count, 1)
+
+    def Allocate(self, start, count):
+        self.SetRange(start, count, 0)
+
+    def NextFree(self, sector, end=None):
+        """ first free sector at or after sector, or end if there is none """
+        return self.Next(sector, end, 1, ANY_FREE)
+
+    def NextAllocated(self, sector, end=None):
+        """ first allocated sector at or after sector, or end if there is none """
+        return self.Next(sector, end, 0, ANY_ALLOCATED)
+
+    def Next(self, sector, end, value, pattern):
+        if end is None:
+            end = self.nSectors
+        while (sector < end) and (sector & 7):
+            if self[sector] == value:
+                return sector
+            sector += 1
+        if sector >= end:
+            return end
+        m = pattern.search(self.bits, sector >> 3, (end + 7) >> 3)
+        if m is None:
+            return end
+        sector = m.start() * 8
+        while (sector < end) and (self[sector] != value):
+            sector += 1
+        return min(sector, end)
+
+    def FreeRuns(self, start=0, end=None):
+        """ yield (start, count) for each run of free sectors """
+        if end is None:
+            end = self.nSectors
+        sector = self.NextFree(start, end)
+        while sector < end:
+            runEnd = self.NextAllocated(sector, end)
+            yield (sector, runEnd - sector)
+            sector = self.NextFree(runEnd, end)
+
+    def FirstFit(self, count, start=0, end=None):
+        """ start of the first free run of at least count sectors, or None """
+        for (runStart, runCount) in self.FreeRuns(start, end):
+            if runCount >= count:
+                return runStart
+        return None
+
+    def WriteBack(self, data):
+        """ Write the changed bytes back to data. Returns the (offset, length)
+            written, or None if nothing had changed.
+        """
+        if self.dirtyLo is None:
+            return None
+        data[self.offset+self.dirtyLo:self.offset+self.dirtyHi] = bytes(self.bits[self.dirtyLo:self.dirtyHi])
+        written = (self.offset+self.dirtyLo, self.dirtyHi-self.dirtyLo)
+        self.dirtyLo = None
+        self.dirtyHi = None
+        return written
+
+def ReadAllocationBitmap(data, vhb=None):
     # 1 = sector is free, 0 = sector is allocated
-    vhb = LoadVHB(data)
+    if not vhb:
+        vhb = LoadVHB(data)
     startOffset = vhb["LfaAllocBitMapbase"]
     nSectors = vhb["SectorsPerTrack"] * vhb["TracksPerCylinder"] * vhb["CylindersPerDisk"]
     bitmapSize = BitmapSize(vhb)
-    bitmap = []
-    for b in data[startOffset:startOffset+bitmapSize]:
-        for i in range(8):
-            bitmap.append(b & 1)
-            b = b >> 1
-    bitmap = bitmap[:nSectors]
-    return bitmap
-
-def WriteAllocationBitmap(data, bitmap):
-    vhb = LoadVHB(data)
-    startOffset = vhb["LfaAllocBitMapbase"]
-    bitmapSize = BitmapSize(vhb)
-    for i in range(bitmapSize):
-        b = 0
-        for j in range(8):
-            bitIndex = i*8 + j
-            if bitIndex < len(bitmap):
-                b = b | (bitmap[bitIndex] << j)
-        struct.pack_into("<B", data, startOffset + i, b)
-
-def GetFreeSector(bitmap):
-    for i, bit in enumerate(bitmap):
-        if bit == 1:
-            bitmap[i] = 0  # Set the bit to allocated
-            return i
-    return None
-
-def RetrieveContents(data, fh):
-    result = ""
-    for extent in fh["extents"]:
-        start = extent[0]
-        end = extent[0] + extent[1]
-        result = result + data[start:end]
+    return AllocationBitmap(data[startOffset:startOffset+bitmapSize], nSectors, startOffset)
+
+def WriteAllocationBitmap(data, bitmap, vhb=None):
+    return bitmap.WriteBack(data)
+
+class Changes(object):
+    """ The structures a mutation has touched, for CheckChanges to verify """
+    def __init__(self):
+        self.headers = set()      # file header numbers
+        self.dirPages = set()     # byte offsets of edited directory pages
+        self.allocated = []       # (start sector, count)
+        self.freed = []           # (start sector, count)
+
+    def Empty(self):
+        return not (self.headers or self.dirPages or self.allocated or self.freed)
+
+    def AddFreedExtents(self, extents):
+        for (sectorAddr, length) in extents:
+            self.freed.append( (sectorAddr//512, int(math.ceil(length/512.0))) )
+
+class CtosVolume(object):
+    """ An image together with the structures decoded from it.
+
+        Each structure (VHB, MFD, directory listings, file headers, allocation
+        bitmap) is decoded the first time it is asked for and then cached.
+        Anything that writes to the image must invalidate what it changed.
+
+        In batch mode (BeginBatch), file headers, the bitmap and the VHB
+        allocation cursor are only updated in the cache, and are written,
+        checksummed and verified once by Commit.
+
+        Every page written through the volume is recorded in dirty, so that
+        WriteBack can save just those pages to the image file.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.deferred = False
+        self.pendingHeaders = {}
+        self.pendingVhb = {}
+        self.dirty = set()
+        self.Invalidate()
+
+    def Invalidate(self):
+        self.changes = Changes()
+        self._vhb = None
+        self._backupVhb = None
+        self._mfd = None
+        self._mfdIndex = None
+        self._bitmap = None
+        self._headerTable = None
+        self.probedDirs = {}
+        self.dirs = {}
+        self.dirIndexes = {}
+        self.probedFiles = {}
+        self.headers = {}
+
+    def InvalidateDirs(self):
+        self.dirs = {}
+        self.dirIndexes = {}
+        self.probedFiles = {}
+
+    def InvalidateHeader(self, fho):
+        self.headers.pop(fho, None)
+        self._headerTable = None
+        # directory listings hold on to the decoded headers
+        self.InvalidateDirs()
+
+    def InvalidateBitmap(self):
+        self._bitmap = None
+
+    def MarkDirty(self, offset, length=PAGE_SIZE):
+        """ record that data[offset:offset+length] has been written """
+        if length > 0:
+            self.dirty.update(range(offset // PAGE_SIZE, (offset + length - 1) // PAGE_SIZE + 1))
+
+    def WriteBack(self, fn, sync=False):
+        """ Write the dirty pages, and only those, to the image file fn.
+            Returns the number of bytes written.
+        """
+        written = WritePages(fn, self.data, PagesToRanges(sorted(self.dirty)), sync)
+        self.dirty = set()
+        return written
+
+    @property
+    def vhb(self):
+        if self._vhb is None:
+            self._vhb = LoadVHB(self.data)
+        return self._vhb
+
+    @property
+    def backupVhb(self):
+        if self._backupVhb is None:
+            self._backupVhb = LoadVHB(self.data, which="backup")
+        return self._backupVhb
+
+    @property
+    def mfd(self):
+        if self._mfd is None:
+            self._mfd = ReadMFD(self.data, vhb=self.vhb)
+        return self._mfd
+
+    @property
+    def mfdIndex(self):
+        """ lower-cased directory name -> MFD entry """
+        if self._mfdIndex is None:
+            self._mfdIndex = {}
+            for mfdEntry in self.mfd:
+                self._mfdIndex.setdefault(mfdEntry["dirNameStr"].lower(), mfdEntry)
+        return self._mfdIndex
+
+    @property
+    def bitmap(self):
+        if self._bitmap is None:
+            self._bitmap = ReadAllocationBitmap(self.data, vhb=self.vhb)
+        return self._bitmap
+
+    @property
+    def headerTable(self):
+        if self._headerTable is None:
+            self._headerTable = FileHeaderTable(self.data, self.vhb)
+        return self._headerTable
+
+    def WriteBitmap(self, bitmap):
+        if self.deferred:
+            self._bitmap = bitmap
+            return
+        written = WriteAllocationBitmap(self.data, bitmap, vhb=self.vhb)
+        if written is not None:
+            self.MarkDirty(*written)
+        # re-read on next use, so that checks see what is actually on disk
+        self.InvalidateBitmap()
+
+    def UpdateVHB(self, values):
+        if self.deferred:
+            for (name, value) in values.items():
+                self.vhb[name] = value
+            self.pendingVhb.update(values)
+            return
+        UpdateVHBFields(self.data, self.vhb["LfaVHB"], values)
+        self.MarkDirty(self.vhb["LfaVHB"])
+        self._vhb = None
+
+    def ReadFileHeader(self, fho):
+        fh = self.headers.get(fho)
+        if fh is None:
+            fh = ReadFileHeader(self.data, fho, vhb=self.vhb)
+            if fh is not None:
+                self.headers[fho] = fh
+        return fh
+
+    def ReadDir(self, name):
+        key = name.lower()
+        entries = self.dirs.get(key)
+        if entries is None:
+            mfdEntry = self.FindDir(name)
+            if not mfdEntry:
+                print("Failed to find %s in mfd" % name, file=sys.stderr)
+                return []
+            entries = MakeDirEntries(ReadDirNames(self.data, mfdEntry, self.vhb), self.ReadFileHeader)
+            self.dirs[key] = entries
+        return entries
+
+    def FindDir(self, name):
+        key = name.lower()
+        if self._mfd is not None:
+            return self.mfdIndex.get(key)
+        # without the whole MFD in hand, probe just the pages the name hashes to
+        if key not in self.probedDirs:
+            self.probedDirs[key] = FindMfdHashed(self.data, name, self.vhb)
+        return self.probedDirs[key]
+
+    def FileIndex(self, dirName):
+        """ lower-cased file name -> directory entry, for one directory """
+        key = dirName.lower()
+        index = self.dirIndexes.get(key)
+        if index is None:
+            index = {}
+            for dirEntry in self.ReadDir(dirName):
+                index.setdefault(dirEntry["name"].lower(), dirEntry)
+            self.dirIndexes[key] = index
+        return index
+
+    def FindDirEntry(self, dirName, fileName):
+        if dirName.lower() in self.dirs:
+            return self.FileIndex(dirName).get(fileName.lower())
+
+        # without the whole listing in hand, probe just the pages the name hashes to
+        key = (dirName.lower(), fileName.lower())
+        if key not in self.probedFiles:
+            dirEntry = None
+            mfdEntry = self.FindDir(dirName)
+            if mfdEntry is not None:
+                entry = FindDirEntryHashed(self.data, mfdEntry, self.vhb, fileName)
+                if entry is not None:
+                    dirEntry = DirEntry(entry[0], entry[1], entry[2], self.ReadFileHeader)
+            self.probedFiles[key] = dirEntry
+        return self.probedFiles[key]
+
+    def FindFile(self, dirName, fileName):
+        dirEntry = self.FindDirEntry(dirName, fileName)
+        if dirEntry is None:
+            return None
+        return dirEntry["fh"]
+
+    def RemoveDirEntry(self, directory, nameToDelete):
+        editedPages = RemoveDirEntry(self.data, directory, nameToDelete, vhb=self.vhb, mfdEntry=self.FindDir(directory))
+        self.changes.dirPages.update(editedPages)
+        for pageOffs in editedPages:
+            self.MarkDirty(pageOffs)
+        self.dirs.pop(directory.lower(), None)
+        self.dirIndexes.pop(directory.lower(), None)
+        self.probedFiles = {}
+
+    def WriteFileHeader(self, fh):
+        """ Checksum and write a file header """
+        self.changes.headers.add(fh["fho"])
+        if self.deferred:
+            self.pendingHeaders[fh["fho"]] = fh
+            self.headers[fh["fho"]] = fh
+            return
+        UpdateFHChecksum(fh)
+        FILE_HEADER_CODEC.pack_into(fh, self.data, fh["offset"])
+        self.MarkDirty(fh["offset"])
+        self.InvalidateHeader(fh["fho"])
+
+    def BeginBatch(self):
+        self.deferred = True
+
+    def Commit(self, fullCheck=False):
+        """ Write out everything deferred since BeginBatch and verify it.
+            Returns the number of errors found.
+        """
+        self.deferred = False
+        for fho in sorted(self.pendingHeaders.keys()):
+            self.WriteFileHeader(self.pendingHeaders[fho])
+        self.pendingHeaders = {}
+        if self._bitmap is not None:
+            self.WriteBitmap(self._bitmap)
+        if self.pendingVhb:
+            self._vhb = None
+            self.UpdateVHB(self.pendingVhb)
+            self.pendingVhb = {}
+        if fullCheck:
+            self.changes = Changes()
+            return CheckDisk(self)
+        return CheckChanges(self)
+
+# the LastAlloc* cursor addresses the bitmap by 512 byte page, 16 bit word and bit
+BITS_PER_BITMAP_PAGE = 512 * 8
+BITS_PER_BITMAP_WORD = 16
+
+class ExtentAllocator(object):
+    """ Allocates contiguous runs of sectors from an AllocationBitmap.
+
+        Free runs are indexed once, sorted by start sector. Requests are
+        rounded up to the VHB's ClusterFactor, and take the first free space
+        that holds the whole request at or after the VHB's LastAlloc* cursor
+        (wrapping around), as CTOS does. If no single run is big enough, the
+        request is split across the longest runs, so that the result has as
+        few extents as possible. AllocSkipCnt sectors are left between
+        successive allocations.
+    """
+    def __init__(self, bitmap, vhb):
+        self.bitmap = bitmap
+        self.clusterFactor = max(1, vhb["ClusterFactor"])
+        self.skipCount = vhb["AllocSkipCnt"]
+        self.cursor = vhb["LastAllocBitMapPage"] * BITS_PER_BITMAP_PAGE + \
+                      vhb["LastAllocWord"] * BITS_PER_BITMAP_WORD + \
+                      vhb["LastAllocBit"]
+        if self.cursor >= len(bitmap):
+            self.cursor = 0
+        self.runs = [list(run) for run in bitmap.FreeRuns()]
+        self.starts = [run[0] for run in self.runs]
+
+    def RoundUp(self, count):
+        return int(math.ceil(count / float(self.clusterFactor))) * self.clusterFactor
+
+    def Usable(self, count):
+        # only whole clusters are handed out
+        return count - (count % self.clusterFactor)
+
+    def FindNextFit(self, count):
+        """ (index, start sector) of the first room for count sectors at or
+            after the cursor, wrapping around to the start of the disk
+        """
+        # the run that holds the cursor, if any, is used from the cursor on
+        first = max(0, bisect.bisect_right(self.starts, self.cursor) - 1)
+        candidates = itertools.chain([(i, self.cursor) for i in range(first, len(self.runs))],
+                                     [(i, 0) for i in range(0, min(first + 1, len(self.runs)))])
+        for (i, lowest) in candidates:
+            (start, length) = self.runs[i]
+            offs = max(start, lowest)
+            if self.Usable(start + length - offs) >= count:
+                return (i, offs)
+        return None
 
-    result = result[:fh["cbFile"]]
+    def FindLongest(self):
+        best = None
+        for (i, run) in enumerate(self.runs):
+            if self.Usable(run[1]) > 0:
+                if (best is None) or (run[1] > self.runs[best][1]):
+                    best = i
+        return best
+
+    def Take(self, i, count, start=None):
+        """ Allocate count sectors of run i from start (by default the start
+            of the run), leaving what is either side of them free
+        """
+        run = self.runs[i]
+        if start is None:
+            start = run[0]
+        end = run[0] + run[1]
+        self.bitmap.Allocate(start, count)
+        pieces = []
+        if start > run[0]:
+            pieces.append([run[0], start - run[0]])
+        if end > start + count:
+            pieces.append([start + count, end - (start + count)])
+        self.runs[i:i+1] = pieces
+        self.starts[i:i+1] = [piece[0] for piece in pieces]
+        self.cursor = start + count + self.skipCount
+        return start
+
+    def Allocate(self, count):
+        """ Allocate at least count sectors. Returns a list of
+            (start sector, sector count) extents, or None if there is not
+            enough free space, in which case nothing is allocated.
+        """
+        count = self.RoundUp(count)
+        if count == 0:
+            return []
+
+        fit = self.FindNextFit(count)
+        if fit is not None:
+            (i, start) = fit
+            return [(self.Take(i, count, start), count)]
+
+        if sum([self.Usable(run[1]) for run in self.runs]) < count:
+            return None
+
+        extents = []
+        while count > 0:
+            i = self.FindLongest()
+            take = min(count, self.Usable(self.runs[i][1]))
+            extents.append( (self.Take(i, take), take) )
+            count -= take
+        return extents
+
+    def CursorFields(self):
+        cursor = self.cursor
+        if cursor >= len(self.bitmap):
+            cursor = 0
+        return {"LastAllocBitMapPage": cursor // BITS_PER_BITMAP_PAGE,
+                "LastAllocWord": (cursor % BITS_PER_BITMAP_PAGE) // BITS_PER_BITMAP_WORD,
+                "LastAllocBit": cursor % BITS_PER_BITMAP_WORD}
+
+try:
+    buffer
+    def BufferView(data, start, end):
+        """ A zero-copy view of data[start:end] """
+        # python 2's mmap only supports the old-style buffer interface
+        return buffer(data, start, end - start)
+except NameError:
+    def BufferView(data, start, end):
+        """ A zero-copy view of data[start:end] """
+        return memoryview(data)[start:end]
+
+def IterExtents(data, extents, cbFile):
+    """ Yield zero-copy views of the data in a list of (lfa, length)
+        extents, one per extent, clipped to cbFile bytes in total.
+    """
+    remaining = cbFile
+    for (start, length) in extents:
+        if remaining <= 0:
+            break
+        length = min(length, remaining)
+        yield BufferView(data, start, start + length)
+        remaining -= length
+
+def IterContents(data, fh):
+    """ Yield zero-copy views of a file's contents, one per extent """
+    return IterExtents(data, fh["extents"], fh["cbFile"])
+
+def WriteExtents(data, extents, cbFile, f):
+    written = 0
+    for chunk in IterExtents(data, extents, cbFile):
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+def WriteContents(data, fh, f):
+    """ Write a file's contents to a file object, without copying them """
+    return WriteExtents(data, fh["extents"], fh["cbFile"], f)
+
+def ContentsEqual(data, fh, expected):
+    offs = 0
+    for chunk in IterContents(data, fh):
+        if chunk != BufferView(expected, offs, offs + len(chunk)):
+            return False
+        offs += len(chunk)
+    return offs == len(expected)
+
+def HashExtents(data, extents, cbFile, algorithm="sha256"):
+    """ Hex digest of the data in a list of extents, fed to the hash one
+        extent at a time rather than joined into one string
+    """
+    h = hashlib.new(algorithm)
+    for chunk in IterExtents(data, extents, cbFile):
+        h.update(chunk)
+    return h.hexdigest()
+
+def HashContents(data, fh, algorithm="sha256"):
+    return HashExtents(data, fh["extents"], fh["cbFile"], algorithm)
 
-    return result
+def RetrieveContents(data, fh):
+    return b"".join([bytes(chunk) for chunk in IterContents(data, fh)])
 
 def TruncateContents(data, fh, bitmap):
     for extent in fh["extents"]:
         (sectorAddr, length) = extent
         sector = sectorAddr/512
         count =  int(math.ceil(length/512.0))
-        for i in range(count):
-            bitmap[sector + i] = 1
+        bitmap.Free(sector, count)
     fh["extents"] = []
 
-def Delete(data, directory, fh, bitmap):
-    TruncateContents(data, fh, bitmap)
-    WriteAllocationBitmap(data, bitmap)
-    RemoveDirEntry(data, directory, fh["nameStr"])
+def VerifyAfterChange(vol, fullCheck, what):
+    if vol.deferred:
+        # checked once, by Commit
+        return
+    if fullCheck:
+        errors = CheckDisk(vol)
+    else:
+        errors = CheckChanges(vol)
+    if errors != 0:
+        print("Error: disk check failed after %s" % what, file=sys.stderr)
+        sys.exit(-1)
+
+def Delete(vol, directory, fh, fullCheck=False):
+    bitmap = vol.bitmap
+    vol.changes.AddFreedExtents(fh["extents"])
+    TruncateContents(vol.data, fh, bitmap)
+    vol.WriteBitmap(bitmap)
+    vol.RemoveDirEntry(directory, fh["nameStr"])
     MarkFHDeleted(fh)
-    UpdateFHChecksum(fh)
-    EncodeStruct(fh, data, FILE_HEADER_FIELDS, fh["offset"])
+    vol.WriteFileHeader(fh)
 
     # secondary file headers are a pain...
     if fh["vhb"]["AltFileHeaderPageOffset"] > 0:
         secondaryFho = fh["fho"] + fh["vhb"]["AltFileHeaderPageOffset"]
-        secondaryFh = ReadFileHeader(data, secondaryFho)
+        secondaryFh = vol.ReadFileHeader(secondaryFho)
         if secondaryFh["FileHeaderNumber"] == fh["FileHeaderNumber"]:
             MarkFHDeleted(secondaryFh)
-            UpdateFHChecksum(secondaryFh)
-            EncodeStruct(secondaryFh, data, FILE_HEADER_FIELDS, secondaryFh["offset"])
+            vol.WriteFileHeader(secondaryFh)
 
-    errors = CheckDisk(data)
-    if errors != 0:
-        print("Error: disk check failed after ReplaceContents", file=sys.stderr)
-        sys.exit(-1)
+    VerifyAfterChange(vol, fullCheck, "Delete")
 
-def ReplaceContents(data, fh, bitmap, srcData):
+def ReplaceContents(vol, fh, srcData, fullCheck=False):
+    data = vol.data
+    bitmap = vol.bitmap
+    vol.changes.AddFreedExtents(fh["extents"])
     TruncateContents(data, fh, bitmap)
 
     origSrcData = srcData
 
     newLen = len(srcData)
-    curExtent = None
-    while len(srcData) > 0:
-        sector = GetFreeSector(bitmap)
-        if sector is None:
-            print("Error: no free sectors available", file=sys.stderr)
-            sys.exit(-1)
-
-        sectorAddr = sector*512
-
-        thisData = srcData[:512]
-        srcData = srcData[512:]
+    allocator = ExtentAllocator(bitmap, vol.vhb)
+    extents = allocator.Allocate(int(math.ceil(newLen/512.0)))
+    if extents is None:
+        print("Error: no free sectors available", file=sys.stderr)
+        sys.exit(-1)
+    if len(extents) > 32:
+        print("Error: free space is too fragmented (%d extents needed)" % len(extents), file=sys.stderr)
+        sys.exit(-1)
 
-        if curExtent != None and (curExtent[0] + curExtent[1] == sectorAddr):
-            # extend current extent
-            curExtent[1] += 512
-            fh["extents"][-1] = curExtent
-        else:
-            curExtent = [sectorAddr, 512]
-            fh["extents"].append(curExtent)
+    vol.changes.allocated.extend(extents)
 
-        fh["cbFile"] = newLen
+    srcOffs = 0
+    for (sector, count) in extents:
+        sectorAddr = sector*512
+        length = count*512
+        data[sectorAddr:sectorAddr+length] = srcData[srcOffs:srcOffs+length].ljust(length, '\x00')
+        vol.MarkDirty(sectorAddr, length)
+        fh["extents"].append( (sectorAddr, length) )
+        srcOffs += length
 
-        struct.pack_into("<512s", data, sectorAddr, thisData.ljust(512, '\x00'))
+    fh["cbFile"] = newLen
 
     EncodeExtents(fh)
-    UpdateFHChecksum(fh)
-    EncodeStruct(fh, data, FILE_HEADER_FIELDS, fh["offset"])
+    vol.WriteFileHeader(fh)
 
-    WriteAllocationBitmap(data, bitmap)
+    vol.WriteBitmap(bitmap)
+    vol.UpdateVHB(allocator.CursorFields())
 
-    errors = CheckDisk(data)
-    if errors != 0:
-        print("Error: disk check failed after ReplaceContents", file=sys.stderr)
-        sys.exit(-1)
+    VerifyAfterChange(vol, fullCheck, "ReplaceContents")
 
-    fh = ReadFileHeader(data, fh["fho"])
-    writtenContents = RetrieveContents(data, fh)
-    if writtenContents != origSrcData:
+    fh = vol.ReadFileHeader(fh["fho"])
+    if not ContentsEqual(data, fh, origSrcData):
         print("Error: contents verification failed after ReplaceContents", file=sys.stderr)
-        #open("/tmp/one","w").write(writtenContents)
-        #open("/tmp/two","w").write(origSrcData)
         sys.exit(-1)
 
-def CheckFHChecksum(fh):
-    data = bytearray(512)
-    EncodeStruct(fh, data, FILE_HEADER_FIELDS, 0)
-    w = fh["vhb"]["MagicWd"]
-    for i in range(256):
-        w = (w - struct.unpack_from("<H", data, 2*i)[0]) & 0xFFFF
-    return (w==0)
+def CheckFHChecksum(fh, data=None):
+    """ Check a file header's checksum. If data is given the header is
+        checked as it is on disk, otherwise it is encoded first.
+    """
+    if data is None:
+        data = bytearray(512)
+        FILE_HEADER_CODEC.pack_into(fh, data, 0)
+        offset = 0
+    else:
+        offset = fh["offset"]
+    return SumWords(data, offset, 256) == fh["vhb"]["MagicWd"]
 
 def UpdateFHChecksum(fh):
     data = bytearray(512)
     fh["Checksum"] = 0
-    EncodeStruct(fh, data, FILE_HEADER_FIELDS, 0)
-    w = 0
-    for i in range(0,256):
-        w = (w + struct.unpack_from("<H", data, 2*i)[0]) & 0xFFFF
-    fh["Checksum"] = (fh["vhb"]["MagicWd"] - w) & 0xFFFF
-
-def CheckDisk(data):
-    vhb = LoadVHB(data)
-    bitmap = ReadAllocationBitmap(data)
-    mfd = ReadMFD(data, vhb=vhb)
+    FILE_HEADER_CODEC.pack_into(fh, data, 0)
+    fh["Checksum"] = (fh["vhb"]["MagicWd"] - SumWords(data, 0, 256)) & 0xFFFF
+
+def BadFileHeaders(data, vhb):
+    """ Verify every header in the file header region at once, returning the
+        numbers of the headers whose checksums fail. Unused headers fail too,
+        so callers should only care about the headers they know are in use.
+    """
+    base = vhb["LfaFileHeadersbase"]
+    count = max(0, min(vhb["CPagesFilesHeaders"], (len(data) - base) // 512))
+    words = WordArray(data, base, count*256)
+    magic = vhb["MagicWd"]
+    return [fho for fho in range(count) if (sum(words[fho*256:(fho+1)*256]) & 0xFFFF) != magic]
+
+def CheckDisk(vol):
+    vhb = vol.vhb
+    bitmap = vol.bitmap
+    mfd = vol.mfd
     errors = 0
 
-    foundBitmap = [1]*len(bitmap)
-
-    foundHeaders = {}
+    badHeaders = set(BadFileHeaders(vol.data, vhb))
 
-    foundBitmap[0] = 0  # sector 0 is always allocated
+    foundBitmap = [1]*len(bitmap)
 
-    bitmapSectors = int(math.ceil(BitmapSize(vhb)/512.0))
-    if BitmapSize(vhb) % 512 == 0:
-        # possible bug? Noticed one additional page if bitmap consumed the entire last sector
-        bitmapSectors += 1
-    for i in range(0, bitmapSectors):
-        foundBitmap[vhb["LfaAllocBitMapbase"]/512 + i] = 0
+    table = vol.headerTable
+    foundHeaders = set()
 
-    foundBitmap[vhb["LfaVHB"]/512] = 0
+    # sector 0, the bitmap, the active VHB and the directories
+    for (start, count, what) in ReservedRanges(vol):
+        for i in range(start, min(start + count, len(foundBitmap))):
+            foundBitmap[i] = 0
 
     for mfdEntry in mfd:
-        for i in range(0, mfdEntry["CPages"]):
-            foundBitmap[mfdEntry["LfaDirbase"]/512 + i] = 0
-
-        dirEntries = ReadDir(data, mfdEntry["dirNameStr"], vhb=vhb, mfd=mfd)
+        dirEntries = vol.ReadDir(mfdEntry["dirNameStr"])
         for dirEntry in dirEntries:
-            fh = dirEntry["fh"]
+            fh = dirEntry.fh
+            if fh is None:
+                continue
 
-            if not CheckFHChecksum(fh):
+            if fh["fho"] in badHeaders:
                 print("Error: checksum failure in file header for fn=%s" % fh["nameStr"], file=sys.stderr)
                 errors += 1
 
-            foundHeaders[fh["fho"]] = fh
+            foundHeaders.add(fh["fho"])
 
-            if vhb["AltFileHeaderPageOffset"] > 0:
-                secondaryFho = fh["fho"] + vhb["AltFileHeaderPageOffset"]
-                secondaryFh = ReadFileHeader(data, secondaryFho)
-                if secondaryFh["FileHeaderNumber"] == fh["FileHeaderNumber"]:
-                    foundHeaders[secondaryFho] = secondaryFh
+            secondaryFho = table.Alternate(fh["fho"], vhb["AltFileHeaderPageOffset"])
+            if secondaryFho is not None:
+                foundHeaders.add(secondaryFho)
 
             for extent in fh["extents"]:
                 start = extent[0]
@@ -696,32 +1577,784 @@ def CheckDisk(data):
             errors += 1
 
     #XXX some drama here around secondary file headers
-    for fho in range(0, vhb["CPagesFilesHeaders"]):
-        fh = ReadFileHeader(data, fho)
-        if fh["sbFileName"][0] == '\0':
-            continue
+    for fho in table.InUse():
         if fho not in foundHeaders:
-            print("Error: Found orphaned file header %d name = %s" % (fho, fh["nameStr"]), file=sys.stderr)
+            print("Error: Found orphaned file header %d name = %s" % (fho, vol.ReadFileHeader(fho)["nameStr"]), file=sys.stderr)
             errors += 1
 
     return errors
 
-def DumpEverything(data):
-    vhb = LoadVHB(data)
+def ExtentSectors(fh):
+    """ (start sector, count) for each extent of a file """
+    return [(extent[0]//512, int(math.ceil(extent[1]/512.0))) for extent in fh["extents"]]
+
+def RangeOverlap(ranges, start, count):
+    """ number of sectors of start..start+count covered by a list of
+        non-overlapping (start, count) ranges
+    """
+    total = 0
+    for (rangeStart, rangeCount) in ranges:
+        lo = max(start, rangeStart)
+        hi = min(start + count, rangeStart + rangeCount)
+        if hi > lo:
+            total += hi - lo
+    return total
+
+def ReservedRanges(vol):
+    """ sectors that CheckDisk accounts for outside of any file """
+    vhb = vol.vhb
+    ranges = [(0, 1, "sector 0"),
+              (vhb["LfaAllocBitMapbase"]//512, BitmapSectors(vhb), "allocation bitmap"),
+              (vhb["LfaVHB"]//512, 1, "active VHB")]
+    for mfdEntry in vol.mfd:
+        ranges.append( (mfdEntry["LfaDirbase"]//512, mfdEntry["CPages"], "directory %s" % mfdEntry["dirNameStr"]) )
+    # the bitmap counts physical sectors, which can outnumber the 512 byte
+    # pages in the image when sectors are smaller than that
+    diskPages = len(vol.data)//512
+    if diskPages < len(vol.bitmap):
+        ranges.append( (diskPages, len(vol.bitmap) - diskPages, "past the end of the image") )
+    return ranges
+
+def CheckChanges(vol, changes=None):
+    """ Verify only the structures recorded in a Changes, rather than the
+        whole disk: the touched file headers and their alternates, the
+        allocation bitmap over the sectors that were allocated or freed, and
+        the directory pages that were edited. Returns the number of errors,
+        as CheckDisk does. Use CheckDisk for a full check.
+    """
+    if changes is None:
+        changes = vol.changes
+    vol.changes = Changes()
+
+    vhb = vol.vhb
+    bitmap = vol.bitmap
+    altOffset = vhb["AltFileHeaderPageOffset"]
+    reserved = ReservedRanges(vol)
+    errors = 0
+
+    owned = []
+    for fho in sorted(changes.headers):
+        fh = vol.ReadFileHeader(fho)
+        if fh is None:
+            errors += 1
+            continue
+
+        if not CheckFHChecksum(fh, vol.data):
+            print("Error: checksum failure in file header %d fn=%s" % (fho, fh["nameStr"]), file=sys.stderr)
+            errors += 1
+
+        if (altOffset > 0) and (fho < altOffset):
+            secondaryFh = vol.ReadFileHeader(fho + altOffset)
+            if (secondaryFh is not None) and (secondaryFh["FileHeaderNumber"] == fh["FileHeaderNumber"]):
+                if secondaryFh["sbFileName"] != fh["sbFileName"]:
+                    print("Error: alternate file header %d does not match %d" % (fho + altOffset, fho), file=sys.stderr)
+                    errors += 1
+
+        if (fh["sbFileName"][0] == '\0') or (fho != fh["FileHeaderNumber"]):
+            # deleted, or an alternate header whose extents the primary owns
+            continue
+
+        for (start, count) in ExtentSectors(fh):
+            if bitmap.CountFree(start, start + count) != 0:
+                print("Error: allocation bitmap mismatch in sectors %d-%d, fn=%s" % (start, start + count - 1, fh["nameStr"]), file=sys.stderr)
+                errors += 1
+            for (rangeStart, rangeCount, what) in reserved:
+                if RangeOverlap([(rangeStart, rangeCount)], start, count):
+                    print("Error: sectors %d-%d of fn=%s overlap the %s" % (start, start + count - 1, fh["nameStr"], what), file=sys.stderr)
+                    errors += 1
+            if RangeOverlap(owned, start, count):
+                print("Error: sectors %d-%d allocated more than once, fn=%s" % (start, start + count - 1, fh["nameStr"]), file=sys.stderr)
+                errors += 1
+            owned.append( (start, count) )
+
+    # Every sector that was allocated or freed must now either belong to one
+    # of the touched files or be free. (A batch may free what it allocated,
+    # or hand freed sectors straight to another file.)
+    for (start, count) in changes.allocated + changes.freed:
+        expectFree = count - RangeOverlap(owned, start, count)
+        if bitmap.CountFree(start, start + count) != expectFree:
+            print("Error: allocation bitmap mismatch in sectors %d-%d, which belong to no changed file" % (start, start + count - 1), file=sys.stderr)
+            errors += 1
+
+    for pageOffs in sorted(changes.dirPages):
+        for (name, fho, entryOffs) in ReadDirPageNames(vol.data, pageOffs, vhb):
+            fh = vol.ReadFileHeader(fho)
+            if fh is None:
+                errors += 1
+            elif fh["sbFileName"][0] == '\0':
+                print("Error: directory entry %s refers to deleted file header %d" % (name, fho), file=sys.stderr)
+                errors += 1
+            elif fh["nameStr"] != name:
+                print("Error: file header name mismatch %s != %s" % (name, fh["nameStr"]), file=sys.stderr)
+                errors += 1
+
+    return errors
+
+# VHB fields holding an LFA, with the field holding the size of the area in pages
+VHB_AREAS = [
+    ("LfaSysImagebase", "CPagesSysImage"),
+    ("LfaBadBlkbase", "CPagesBadBlk"),
+    ("LfaCrashDumpbase", "CPagesCrashDump"),
+    ("LfaMFDbase", "CPagedMFD"),
+    ("LfaLogbase", "CPagesLog"),
+    ("LfaFileHeadersbase", "CPagesFilesHeaders"),
+]
+
+# areas the VHB also addresses by cylinder, head and sector: (LFA field,
+# pages field, prefix of the Cylinder/Head/Sector fields)
+CHS_AREAS = [
+    ("LfaSysImagebase", "CPagesSysImage", "SysImageBase"),
+    ("LfaBadBlkbase", "CPagesBadBlk", "BadBlkBase"),
+    ("LfaCrashDumpbase", "CPagesCrashDump", "DumpBase"),
+]
+
+def GeometryFields(cylinders, heads, sectors, bytesPerSector):
+    return {"CylindersPerDisk": cylinders,
+            "TracksPerCylinder": heads,
+            "SectorsPerTrack": sectors,
+            "BytesPerSector": bytesPerSector}
+
+def LfaToChs(lfa, geometry, startingSector=0):
+    """ (cylinder, head, sector) of a byte address, for a geometry given as
+        GeometryFields. Sectors on a track are numbered from startingSector.
+    """
+    sector = lfa // geometry["BytesPerSector"]
+    sectorsPerCylinder = geometry["SectorsPerTrack"] * geometry["TracksPerCylinder"]
+    return (sector // sectorsPerCylinder,
+            (sector // geometry["SectorsPerTrack"]) % geometry["TracksPerCylinder"],
+            startingSector + sector % geometry["SectorsPerTrack"])
+
+def ChsFields(vhb, geometry):
+    """ the CHS fields of a VHB, worked out from the LFAs in it for a new
+        geometry. Areas with no pages are addressed as 0/0/0.
+    """
+    values = {}
+    for (lfaField, pagesField, prefix) in CHS_AREAS:
+        if vhb[pagesField] > 0:
+            (cylinder, head, sector) = LfaToChs(vhb[lfaField], geometry, vhb["StartingSector"])
+        else:
+            (cylinder, head, sector) = (0, 0, 0)
+        values[prefix + "Cylinder"] = cylinder
+        values[prefix + "Head"] = head
+        values[prefix + "Sector"] = sector
+    return values
+
+def MergeRanges(ranges):
+    """ sort (start, count) ranges and merge the ones that overlap or touch """
+    merged = []
+    for (start, count) in sorted(ranges):
+        if count <= 0:
+            continue
+        if merged and (start <= merged[-1][0] + merged[-1][1]):
+            last = merged[-1]
+            merged[-1] = (last[0], max(last[1], start + count - last[0]))
+        else:
+            merged.append( (start, count) )
+    return merged
+
+class Relocation(object):
+    """ Where each run of in-use sectors moves to when a volume is compacted.
+        Runs keep their order and are packed down from sector 0, so an LFA
+        anywhere inside a run moves by the size of the gaps before it.
+    """
+    def __init__(self, runs):
+        self.runs = []
+        self.starts = []
+        newStart = 0
+        for (start, count) in runs:
+            self.runs.append( (start, count, newStart) )
+            self.starts.append(start)
+            newStart += count
+        self.nSectors = newStart
+
+    def Covers(self, lfa):
+        i = bisect.bisect_right(self.starts, lfa//512) - 1
+        return (i >= 0) and (lfa//512 < self.runs[i][0] + self.runs[i][1])
+
+    def Remap(self, lfa):
+        if not self.Covers(lfa):
+            print("Error: LFA %d is not in any area that is being kept" % lfa, file=sys.stderr)
+            sys.exit(-1)
+        (start, count, newStart) = self.runs[bisect.bisect_right(self.starts, lfa//512) - 1]
+        return lfa + (newStart - start)*512
+
+def PlanCompaction(vol, newVhb):
+    """ The runs of sectors a compacted copy of vol has to keep, for a volume
+        with newVhb's geometry: everything the VHB, the MFD and the file
+        headers point at. The bitmap is sized for the new geometry, since it
+        is rebuilt rather than copied.
+    """
+    vhb = vol.vhb
+    ranges = [(0, 1),
+              (vhb["LfaInitialVHB"]//512, 1),
+              (vhb["LfaVHB"]//512, 1)]
+    for (lfaField, pagesField) in VHB_AREAS:
+        if vhb[pagesField] > 0:
+            ranges.append( (vhb[lfaField]//512, vhb[pagesField]) )
+
+    oldBitmapSectors = BitmapSectors(vhb)
+    newBitmapSectors = BitmapSectors(newVhb)
+    bitmapStart = vhb["LfaAllocBitMapbase"]//512
+    ranges.append( (bitmapStart, newBitmapSectors) )
+
+    for mfdEntry in vol.mfd:
+        ranges.append( (mfdEntry["LfaDirbase"]//512, mfdEntry["CPages"]) )
+
+    # alternate headers are not kept up to date by replace, so only the
+    # primaries say which sectors are in use
+    table = vol.headerTable
+    for fho in table.Primaries():
+        ranges.extend(ExtentSectors({"extents": table.Extents(fho)}))
+
+    if newBitmapSectors > oldBitmapSectors:
+        grown = (bitmapStart + oldBitmapSectors, newBitmapSectors - oldBitmapSectors)
+        others = [r for r in ranges if r[0] != bitmapStart]
+        if RangeOverlap(MergeRanges(others), grown[0], grown[1]) > 0:
+            print("Error: the allocation bitmap for the new geometry would overlap the sectors after it", file=sys.stderr)
+            sys.exit(-1)
+
+    return Relocation(MergeRanges(ranges))
+
+def Compact(vol, cylinders, heads, sectors, bytesPerSector):
+    """ Copy vol into a new image of the given geometry, with every in-use
+        sector packed down towards sector 0. Each run is moved with a single
+        copy, then every LFA in the VHBs, MFD and file headers is remapped and
+        the allocation bitmap is rebuilt. Returns the new image.
+    """
+    vhb = vol.vhb
+    geometry = GeometryFields(cylinders, heads, sectors, bytesPerSector)
+    newVhb = vhb.copy()
+    for (name, value) in geometry.items():
+        newVhb[name] = value
+
+    newSize = cylinders * heads * sectors * bytesPerSector
+    diskPages = newSize // 512
+    relocation = PlanCompaction(vol, newVhb)
+    if relocation.nSectors > diskPages:
+        print("Error: volume needs %d sectors, but the new geometry only has %d" % (relocation.nSectors, diskPages), file=sys.stderr)
+        sys.exit(-1)
+
+    newData = bytearray(newSize)
+    for (start, count, newStart) in relocation.runs:
+        newData[newStart*512:(newStart+count)*512] = bytes(vol.data[start*512:(start+count)*512])
+
+    # rebuild the bitmap from the relocated runs, leaving anything past the
+    # end of the image allocated
+    nSectors = sectors * heads * cylinders
+    bitmap = AllocationBitmap(bytearray(BitmapSize(newVhb)), nSectors, relocation.Remap(vhb["LfaAllocBitMapbase"]))
+    bitmap.Free(0, min(diskPages, nSectors))
+    for (start, count, newStart) in relocation.runs:
+        bitmap.Allocate(newStart, min(count, nSectors - newStart))
+    bitmap.Touch(0, len(bitmap.bits))
+    bitmap.WriteBack(newData)
+
+    for which in ["active", "backup"]:
+        oldVhb = vol.vhb if (which == "active") else vol.backupVhb
+        values = dict(geometry)
+        for field in ["LfaVHB", "LfaInitialVHB", "LfaAllocBitMapbase"]:
+            values[field] = relocation.Remap(oldVhb[field])
+        for (lfaField, pagesField) in VHB_AREAS:
+            if oldVhb[pagesField] > 0:
+                values[lfaField] = relocation.Remap(oldVhb[lfaField])
+        relocated = oldVhb.copy()
+        for (name, value) in values.items():
+            relocated[name] = value
+        values.update(ChsFields(relocated, geometry))
+        values["CPagesAllocBitMap"] = int(math.ceil(BitmapSize(newVhb)/512.0))
+        values["CFreePages"] = bitmap.CountFree()
+        # the next-fit cursor would point into the old layout
+        values["LastAllocBitMapPage"] = 0
+        values["LastAllocWord"] = 0
+        values["LastAllocBit"] = 0
+        # recently used directories may be cached by LFA; start with none
+        values["RgLruDirEntries"] = b"\x00" * 105
+        offset = values["LfaVHB"] if (which == "active") else values["LfaInitialVHB"]
+        UpdateVHBFields(newData, offset, values)
+
+    newMfdBase = relocation.Remap(vhb["LfaMFDbase"])
+    for i in range(vhb["CPagedMFD"]):
+        offs = newMfdBase + i*512 + 1
+        for j in range(MFD_ENTRIES_PER_PAGE):
+            if ReadByte(newData, offs) != 0:
+                lfaDirbase = struct.unpack_from("<L", newData, offs + 26)[0]
+                struct.pack_into("<L", newData, offs + 26, relocation.Remap(lfaDirbase))
+            offs = offs + MFD_ENTRY_SIZE
+
+    table = vol.headerTable
+    magic = vhb["MagicWd"]
+    primaries = table.Primaries()
+    alternates = sorted(set(table.InUse()) - set(primaries))
+    for fho in primaries + alternates:
+        offs = relocation.Remap(vhb["LfaFileHeadersbase"] + fho*512)
+        primary = table.FileHeaderNumber[fho]
+        if (fho != primary) and (primary in primaries) and (table.Extents(fho) != table.Extents(primary)):
+            # a stale alternate; give it the primary's relocated extents
+            primaryOffs = relocation.Remap(vhb["LfaFileHeadersbase"] + primary*512)
+            newData[offs+111:offs+377] = newData[primaryOffs+111:primaryOffs+377]
+        else:
+            for (i, lfa) in enumerate(table.LfaExtents(fho)):
+                if (lfa != 0) and ((fho == primary) or relocation.Covers(lfa)):
+                    struct.pack_into("<L", newData, offs + 121 + i*4, relocation.Remap(lfa))
+        lfaDirPage = struct.unpack_from("<L", newData, offs + 88)[0]
+        if relocation.Covers(lfaDirPage) and (lfaDirPage != 0):
+            struct.pack_into("<L", newData, offs + 88, relocation.Remap(lfaDirPage))
+        struct.pack_into("<H", newData, offs, 0)
+        struct.pack_into("<H", newData, offs, (magic - SumWords(newData, offs, 256)) & 0xFFFF)
+
+    return newData
+
+def InterleaveOrder(sectors, interleave):
+    """ the logical sector in each physical slot of a track formatted with
+        the given interleave: each sector goes interleave slots after the
+        last one, or in the next empty slot after that
+    """
+    slots = [None] * sectors
+    slot = 0
+    for sector in range(sectors):
+        while slots[slot] is not None:
+            slot = (slot + 1) % sectors
+        slots[slot] = sector
+        slot = (slot + max(1, interleave)) % sectors
+    return slots
+
+def Convert(vol, out, cylinders, heads, sectors, bytesPerSector, interleave=None):
+    """ Write vol to the file object out as an image of another geometry, a
+        track at a time. Nothing moves: the image is cut or padded to the new
+        size, both VHBs get the new geometry and CHS fields, and the bitmap
+        marks sectors past the new end allocated and sectors gained free.
+        With an interleave, the sectors of each track are written in the
+        order they pass the head, and the VHB's InterleaveFactor is set.
+        Use Compact when the volume doesn't fit as it stands. Returns the
+        number of bytes written.
+    """
+    vhb = vol.vhb
+    geometry = GeometryFields(cylinders, heads, sectors, bytesPerSector)
+    newVhb = vhb.copy()
+    for (name, value) in geometry.items():
+        newVhb[name] = value
+
+    trackSize = sectors * bytesPerSector
+    newSize = cylinders * heads * trackSize
+    newPages = newSize // 512
+    nSectors = sectors * heads * cylinders
+
+    # sectors past the end of the old image are allocated, but not in use
+    oldLimit = min(len(vol.data)//512, len(vol.bitmap))
+    newLimit = min(newPages, nSectors)
+    pinnedEnd = max([min(start + count, oldLimit) for (start, count) in PinnedRanges(vol) if start < oldLimit] + [0])
+    inUse = (newPages < oldLimit) and (vol.bitmap.NextAllocated(newPages, oldLimit) < oldLimit)
+    if (pinnedEnd > newPages) or inUse:
+        print("Error: volume uses sectors past the end of the new geometry (%d sectors); compact it instead" % newPages, file=sys.stderr)
+        sys.exit(-1)
+    if int(math.ceil(BitmapSize(newVhb)/512.0)) > vhb["CPagesAllocBitMap"]:
+        print("Error: the allocation bitmap for the new geometry needs more than the %d pages it has; compact it instead" % vhb["CPagesAllocBitMap"], file=sys.stderr)
+        sys.exit(-1)
+
+    # the bitmap resized for the new geometry
+    bits = bytearray(vol.bitmap.bits[:BitmapSize(newVhb)]).ljust(BitmapSize(newVhb), b"\x00")
+    bitmap = AllocationBitmap(bits, nSectors, vhb["LfaAllocBitMapbase"])
+    if newLimit < nSectors:
+        bitmap.Allocate(newLimit, nSectors - newLimit)
+    if newLimit > oldLimit:
+        bitmap.Free(oldLimit, newLimit - oldLimit)
+
+    # the pages that differ from the source: (offset, contents)
+    patches = [(vhb["LfaAllocBitMapbase"], bytes(bitmap.bits))]
+    for (which, fldName) in [("active", "LfaVHB"), ("backup", "LfaInitialVHB")]:
+        oldVhb = vol.vhb if (which == "active") else vol.backupVhb
+        offset = oldVhb[fldName]
+        page = bytearray(vol.data[offset:offset+512])
+        values = dict(geometry)
+        values.update(ChsFields(oldVhb, geometry))
+        values["CFreePages"] = bitmap.CountFree()
+        if interleave is not None:
+            values["InterleaveFactor"] = interleave
+        UpdateVHBFields(page, 0, values)
+        patches.append( (offset, bytes(page)) )
+
+    order = InterleaveOrder(sectors, interleave) if interleave is not None else None
+    written = 0
+    for trackStart in range(0, newSize, trackSize):
+        trackEnd = trackStart + trackSize
+        track = bytearray(vol.data[trackStart:min(trackEnd, len(vol.data))]).ljust(trackSize, b"\x00")
+        for (offset, contents) in patches:
+            lo = max(offset, trackStart)
+            hi = min(offset + len(contents), trackEnd)
+            if hi > lo:
+                track[lo-trackStart:hi-trackStart] = contents[lo-offset:hi-offset]
+        if order is not None:
+            track = b"".join([bytes(track[sector*bytesPerSector:(sector+1)*bytesPerSector]) for sector in order])
+        out.write(track)
+        written += len(track)
+    return written
+
+def FileOrder(vol):
+    """ the primary header of every file, in MFD order and then directory
+        order, which is the order defrag lays files out in
+    """
+    files = []
+    seen = set()
+    for mfdEntry in vol.mfd:
+        for dirEntry in vol.ReadDir(mfdEntry["dirNameStr"]):
+            fh = dirEntry.fh
+            if (fh is None) or (fh["fho"] in seen):
+                continue
+            seen.add(fh["fho"])
+            files.append(fh)
+    return files
+
+def LayoutStats(vol, files):
+    """ (extents, seek distance in sectors, seek distance in cylinders) to
+        read every file in files, in order
+    """
+    vhb = vol.vhb
+    sectorsPerCylinder = max(1, vhb["SectorsPerTrack"] * vhb["TracksPerCylinder"] * vhb["BytesPerSector"] // 512)
+    extents = 0
+    seek = 0
+    cylinderSeek = 0
+    head = 0
+    for fh in files:
+        for (start, count) in ExtentSectors(fh):
+            extents += 1
+            seek += abs(start - head)
+            cylinderSeek += abs(start//sectorsPerCylinder - head//sectorsPerCylinder)
+            head = start + count
+    return (extents, seek, cylinderSeek)
+
+def PinnedRanges(vol):
+    """ sectors defrag must not move: everything the VHB and MFD point at """
+    vhb = vol.vhb
+    ranges = [(start, count) for (start, count, what) in ReservedRanges(vol)]
+    ranges.append( (vhb["LfaInitialVHB"]//512, 1) )
+    for (lfaField, pagesField) in VHB_AREAS:
+        if vhb[pagesField] > 0:
+            ranges.append( (vhb[lfaField]//512, vhb[pagesField]) )
+    return MergeRanges(ranges)
+
+def MovableFiles(vol, files):
+    """ the files in files that don't hold a system area, as FileHeaders.sys
+        and Mfd.sys do
+    """
+    pinned = PinnedRanges(vol)
+    return [fh for fh in files
+            if not [e for e in ExtentSectors(fh) if RangeOverlap(pinned, e[0], e[1]) > 0]]
+
+def PlanDefrag(vol, movable):
+    """ Work out where each of the movable files goes. They are laid out in
+        order, each in the first free run after the previous one that is big
+        enough to hold all of it, or split across as few runs as possible if
+        there is none. Returns a list of (fh, [(start sector, count), ...]).
+    """
+
+    # the free space once every movable file has been picked up
+    bitmap = vol.bitmap
+    space = AllocationBitmap(bitmap.bits, bitmap.nSectors, bitmap.offset)
+    for fh in movable:
+        for (start, count) in ExtentSectors(fh):
+            space.Free(start, count)
+
+    plan = []
+    cursor = 0
+    for fh in movable:
+        count = sum([extent[1] for extent in ExtentSectors(fh)])
+        if count == 0:
+            continue
+        start = space.FirstFit(count, cursor)
+        if start is None:
+            start = space.FirstFit(count)
+        if start is not None:
+            target = [(start, count)]
+        else:
+            target = []
+            need = count
+            for (runStart, runCount) in space.FreeRuns(cursor):
+                target.append( (runStart, min(runCount, need)) )
+                need -= target[-1][1]
+                if need == 0:
+                    break
+            for (runStart, runCount) in space.FreeRuns(0, cursor):
+                if need == 0:
+                    break
+                target.append( (runStart, min(runCount, need)) )
+                need -= target[-1][1]
+            if (need > 0) or (len(target) > 32):
+                print("Error: no room to lay out fn=%s" % fh["nameStr"], file=sys.stderr)
+                sys.exit(-1)
+        for (runStart, runCount) in target:
+            space.Allocate(runStart, runCount)
+        cursor = target[-1][0] + target[-1][1]
+        plan.append( (fh, target) )
+    return plan
+
+def SectorList(ranges):
+    return [sector for (start, count) in ranges for sector in range(start, start + count)]
+
+def Defrag(vol, fullCheck=True):
+    """ Lay out every file that can move contiguously, in directory order.
+        Every sector that moves is read before any is written, and only
+        sectors whose position changes are copied. Returns (layout before,
+        layout after, sectors copied), where a layout is what LayoutStats
+        returns for the files that can move.
+    """
+    data = vol.data
+    vhb = vol.vhb
+    movable = MovableFiles(vol, FileOrder(vol))
+    before = LayoutStats(vol, movable)
+    plan = PlanDefrag(vol, movable)
+
+    table = vol.headerTable
+    moves = []
+    for (fh, target) in plan:
+        sources = SectorList(ExtentSectors(fh))
+        targets = SectorList(target)
+        moved = [(src, dst) for (src, dst) in zip(sources, targets) if src != dst]
+        if moved or (len(fh["extents"]) != len(target)):
+            secondaryFho = table.Alternate(fh["fho"], vhb["AltFileHeaderPageOffset"])
+            moves.append( (fh, secondaryFho, target, moved, [bytes(data[src*512:(src+1)*512]) for (src, dst) in moved]) )
+
+    copied = 0
+    bitmap = vol.bitmap
+    for (fh, secondaryFho, target, moved, contents) in moves:
+        vol.changes.AddFreedExtents(fh["extents"])
+        for (start, count) in ExtentSectors(fh):
+            bitmap.Free(start, count)
+    for (fh, secondaryFho, target, moved, contents) in moves:
+        # consecutive destinations go in a single copy
+        i = 0
+        while i < len(moved):
+            j = i + 1
+            while (j < len(moved)) and (moved[j][1] == moved[j-1][1] + 1):
+                j += 1
+            data[moved[i][1]*512:(moved[j-1][1]+1)*512] = b"".join(contents[i:j])
+            vol.MarkDirty(moved[i][1]*512, (moved[j-1][1]+1-moved[i][1])*512)
+            i = j
+        copied += len(moved)
+
+        for (start, count) in target:
+            bitmap.Allocate(start, count)
+            vol.changes.allocated.append( (start, count) )
+
+        extents = [(start*512, count*512) for (start, count) in target]
+        headers = [fh]
+        if secondaryFho is not None:
+            headers.append(vol.ReadFileHeader(secondaryFho))
+        for header in headers:
+            header["extents"] = extents
+            EncodeExtents(header)
+            vol.WriteFileHeader(header)
+    vol.WriteBitmap(bitmap)
+
+    VerifyAfterChange(vol, fullCheck, "defrag")
+
+    after = LayoutStats(vol, [vol.ReadFileHeader(fh["fho"]) for fh in movable])
+    return (before, after, copied)
+
+# pages compared at a time before narrowing down to the ones that differ
+DIFF_BLOCK_PAGES = 64
+
+def DiffPages(data1, data2, blockPages=DIFF_BLOCK_PAGES):
+    """ sorted list of the 512 byte pages that differ between two images.
+        Pages that only one image has count as different.
+    """
+    common = min(len(data1), len(data2))
+    blockSize = blockPages * PAGE_SIZE
+    pages = []
+    for start in range(0, common, blockSize):
+        end = min(start + blockSize, common)
+        if BufferView(data1, start, end) == BufferView(data2, start, end):
+            continue
+        for offs in range(start, end, PAGE_SIZE):
+            pageEnd = min(offs + PAGE_SIZE, end)
+            if BufferView(data1, offs, pageEnd) != BufferView(data2, offs, pageEnd):
+                pages.append(offs // PAGE_SIZE)
+    longest = max(len(data1), len(data2))
+    pages.extend(range((common + PAGE_SIZE - 1) // PAGE_SIZE, (longest + PAGE_SIZE - 1) // PAGE_SIZE))
+    return sorted(set(pages))
+
+def PagesToRanges(pages):
+    """ (start, count) runs of consecutive numbers in a sorted list """
+    ranges = []
+    for page in pages:
+        if ranges and (ranges[-1][0] + ranges[-1][1] == page):
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append( (page, 1) )
+    return ranges
+
+def FormatRanges(ranges):
+    return ", ".join([("%d" % start) if count == 1 else ("%d-%d" % (start, start + count - 1)) for (start, count) in ranges])
+
+def PagesIn(pages, start, count):
+    """ the pages of a sorted list that lie in start..start+count """
+    return pages[bisect.bisect_left(pages, start):bisect.bisect_left(pages, start + count)]
+
+def FormatValue(value):
+    if isinstance(value, (bytes, bytearray)) and [c for c in bytearray(value) if chr(c) not in string.printable]:
+        return "<%d bytes>" % len(value)
+    return str(value)
+
+def DiffFields(old, new, skip=()):
+    """ (name, old value, new value) for each field that differs between two
+        decoded structures
+    """
+    return [(k, old.get(k), new.get(k)) for k in sorted(set(old.keys()) | set(new.keys()))
+            if (k not in skip) and (old.get(k) != new.get(k))]
+
+def PrintFieldDiffs(what, diffs):
+    for (k, oldValue, newValue) in diffs:
+        print("%s: %s %s -> %s" % (what, k, FormatValue(oldValue), FormatValue(newValue)))
+
+# fields that are either derived from others or raw bytes already decoded
+# into another field. Checksums change along with everything else, so a
+# changed page with no other field differences is reported on its own.
+DIFF_SKIP_VHB = ["Checksum"]
+DIFF_SKIP_MFD = ["DirectoryName", "DirPassword"]
+DIFF_SKIP_FH = ["Checksum", "vhb", "offset", "sbFileName", "rgLfaExtents", "rgcbExtents", "iFreeRun"]
+
+def VolumeFiles(vol):
+    """ every file of a volume, keyed by (directory, name) folded to lower
+        case, as (directory name, file name, fh)
+    """
+    files = {}
+    for mfdEntry in vol.mfd:
+        dirName = mfdEntry["dirNameStr"]
+        for dirEntry in vol.ReadDir(dirName):
+            fh = dirEntry.fh
+            if fh is not None:
+                files[(dirName.lower(), dirEntry["name"].lower())] = (dirName, dirEntry["name"], fh)
+    return files
+
+def FileHeaderPages(vol, fh):
+    """ the pages holding a file's header and its alternate """
+    vhb = vol.vhb
+    pages = [fh["offset"] // PAGE_SIZE]
+    altOffset = vhb["AltFileHeaderPageOffset"]
+    if (altOffset > 0) and (fh["fho"] < altOffset):
+        pages.append(pages[0] + altOffset)
+    return pages
+
+def DiffVolumes(vol1, vol2):
+    """ Print what changed between two images: first the 512 byte pages that
+        differ, then, working back from those pages through the VHBs, MFD,
+        directories, file headers, extents and allocation bitmap, the
+        metadata fields, directories and files that changed. Pages that no
+        structure in either image accounts for are listed at the end. Returns
+        the number of pages that differ.
+    """
+    (data1, data2) = (vol1.data, vol2.data)
+    pages = DiffPages(data1, data2)
+    totalPages = (max(len(data1), len(data2)) + PAGE_SIZE - 1) // PAGE_SIZE
+    print("Sectors: %d of %d differ%s" % (len(pages), totalPages, (": " + FormatRanges(PagesToRanges(pages))) if pages else ""))
+    if len(data1) != len(data2):
+        print("Image size: %d -> %d" % (len(data1), len(data2)))
+    if not pages:
+        return 0
+
+    PrintFieldDiffs("VHB (backup)", DiffFields(vol1.backupVhb, vol2.backupVhb, DIFF_SKIP_VHB))
+    PrintFieldDiffs("VHB (active)", DiffFields(vol1.vhb, vol2.vhb, DIFF_SKIP_VHB))
+
+    # everything either volume accounts for, to find the pages nothing does
+    owned = []
+    for vol in [vol1, vol2]:
+        owned.extend(PinnedRanges(vol))
+
+    mfd1 = dict([(m["dirNameStr"].lower(), m) for m in vol1.mfd])
+    mfd2 = dict([(m["dirNameStr"].lower(), m) for m in vol2.mfd])
+    for key in sorted(set(mfd1.keys()) | set(mfd2.keys())):
+        if key not in mfd2:
+            print("Directory %s: deleted" % mfd1[key]["dirNameStr"])
+        elif key not in mfd1:
+            print("Directory %s: added" % mfd2[key]["dirNameStr"])
+        else:
+            (m1, m2) = (mfd1[key], mfd2[key])
+            PrintFieldDiffs("Directory %s" % m2["dirNameStr"], DiffFields(m1, m2, DIFF_SKIP_MFD))
+            changed = set(PagesIn(pages, m1["LfaDirbase"]//PAGE_SIZE, m1["CPages"]) + PagesIn(pages, m2["LfaDirbase"]//PAGE_SIZE, m2["CPages"]))
+            if changed:
+                print("Directory %s: %d pages changed" % (m2["dirNameStr"], len(changed)))
+
+    files1 = VolumeFiles(vol1)
+    files2 = VolumeFiles(vol2)
+    for key in sorted(set(files1.keys()) | set(files2.keys())):
+        if key not in files2:
+            (dirName, fileName, fh) = files1[key]
+            print("File %s/%s: deleted (%d bytes)" % (dirName, fileName, fh["cbFile"]))
+            owned.extend(ExtentSectors(fh))
+            continue
+        if key not in files1:
+            (dirName, fileName, fh) = files2[key]
+            print("File %s/%s: added (%d bytes)" % (dirName, fileName, fh["cbFile"]))
+            owned.extend(ExtentSectors(fh))
+            continue
+
+        (dirName, fileName, fh1) = files1[key]
+        fh2 = files2[key][2]
+        what = "File %s/%s" % (dirName, fileName)
+        owned.extend(ExtentSectors(fh1))
+        owned.extend(ExtentSectors(fh2))
+
+        diffs = DiffFields(fh1, fh2, DIFF_SKIP_FH)
+        PrintFieldDiffs(what, diffs)
+
+        headerPages = set(FileHeaderPages(vol1, fh1) + FileHeaderPages(vol2, fh2))
+        if (not diffs) and [page for page in headerPages if PagesIn(pages, page, 1)]:
+            print("%s: header changed outside the decoded fields" % what)
+
+        # contents can only differ if the data moved, or some of it changed
+        dataChanged = [e for e in ExtentSectors(fh1) + ExtentSectors(fh2) if PagesIn(pages, e[0], e[1])]
+        if (fh1["cbFile"] != fh2["cbFile"]) or ((dataChanged or (fh1["extents"] != fh2["extents"])) and (HashContents(data1, fh1) != HashContents(data2, fh2))):
+            print("%s: contents differ" % what)
+
+    bitmap1 = vol1.bitmap
+    bitmap2 = vol2.bitmap
+    allocated = []
+    freed = []
+    for byte in range(min(len(bitmap1.bits), len(bitmap2.bits))):
+        if bitmap1.bits[byte] == bitmap2.bits[byte]:
+            continue
+        for sector in range(byte*8, min(byte*8 + 8, len(bitmap1), len(bitmap2))):
+            if bitmap1[sector] and not bitmap2[sector]:
+                allocated.append(sector)
+            elif bitmap2[sector] and not bitmap1[sector]:
+                freed.append(sector)
+    if allocated:
+        print("Bitmap: %d sectors allocated: %s" % (len(allocated), FormatRanges(PagesToRanges(allocated))))
+    if freed:
+        print("Bitmap: %d sectors freed: %s" % (len(freed), FormatRanges(PagesToRanges(freed))))
+
+    owned = MergeRanges(owned)
+    ownedStarts = [start for (start, count) in owned]
+    free = []
+    unaccounted = []
+    for page in pages:
+        i = bisect.bisect_right(ownedStarts, page) - 1
+        if (i >= 0) and (page < owned[i][0] + owned[i][1]):
+            continue
+        inBoth = (page < len(bitmap1)) and (page < len(bitmap2))
+        if inBoth and bitmap1[page] and bitmap2[page]:
+            free.append(page)
+        else:
+            unaccounted.append(page)
+    if free:
+        print("Free space: %d sectors changed: %s" % (len(free), FormatRanges(PagesToRanges(free))))
+    if unaccounted:
+        print("Unaccounted: %d sectors changed: %s" % (len(unaccounted), FormatRanges(PagesToRanges(unaccounted))))
+
+    return len(pages)
+
+def makeSafeFileName(fn):
+    return fn.replace(">", "_").replace("/", "_")
 
-    allocated = 0
-    bitmap = ReadAllocationBitmap(data)
-    for bit in bitmap:
-        if bit:
-            allocated += 1
+def DumpEverything(vol):
+    allocated = vol.bitmap.CountFree()
 
     print("\nAllocation Bitmap Bits Set: %d sectors free" % allocated)
+    print("File Headers: %d in use, %d files, %d bytes in %d extents" % vol.headerTable.Usage())
 
-    mfd = ReadMFD(data, vhb=vhb)
+    mfd = vol.mfd
     print("\n== MFD:")
     PrintMfd(mfd)
 
     for mfdEntry in mfd:
         print("\n-- Dir %s" % mfdEntry["dirNameStr"])
-        dirEntries = ReadDir(data, mfdEntry["dirNameStr"], vhb=vhb, mfd=mfd)
+        dirEntries = vol.ReadDir(mfdEntry["dirNameStr"])
         PrintDir(dirEntries)
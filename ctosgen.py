@@ -0,0 +1,316 @@
+""" ctosgen.py
+
+    Build synthetic CTOS volumes of a controlled size and shape, for trying
+    out and timing ctostool on something bigger than a floppy. Examples:
+
+    # a 1.44MB floppy with 3 directories of 20 files each
+    ctosgen.py test.img
+
+    # a 30MB hard disk, 20 directories of 200 files, sizes spread
+    # log-normally around 8K, with badly fragmented files and free space
+    ctosgen.py -g 820 4 18 512 -d 20 -f 200 --size-dist lognormal \
+        --max-size 262144 --fragmentation 0.5 hd.img
+
+    The layout follows the volumes CTOS formats: the backup VHB in sector 0,
+    then the file headers (primaries, then alternates), the allocation
+    bitmap, the log and the directories, with the active VHB and the MFD in
+    the middle of the disk. FileHeaders.sys, Mfd.sys and Log.sys in Sys
+    cover the system areas. Files are laid out from the end of the
+    directories on. The generated volume passes chkdsk.
+"""
+
+from __future__ import print_function
+
+from ctosdisk import *
+import argparse
+import random
+
+LOG_PAGES = 4
+MAX_EXTENTS = 32
+
+def LengthPrefixed(s, size):
+    return (chr(len(s)) + s).ljust(size, "\x00")
+
+def ContentPool(rand, size=65536):
+    """ random bytes that file contents are cut from """
+    return bytes(bytearray([rand.getrandbits(8) for i in range(size)]))
+
+def MakeContents(rand, pool, size):
+    start = rand.randint(0, len(pool) - 1)
+    contents = pool[start:] + pool[:start]
+    return (contents * (size // len(contents) + 1))[:size]
+
+def FileSize(rand, minSize, maxSize, sizeDist):
+    if sizeDist == "lognormal":
+        # median in the geometric middle of the range
+        median = math.sqrt(max(1, minSize) * max(1, maxSize))
+        size = int(rand.lognormvariate(math.log(median), 1.0))
+    else:
+        size = rand.randint(minSize, maxSize)
+    return max(minSize, min(maxSize, size))
+
+def AddMfdEntry(data, vhb, name, lfaDirbase, pages):
+    """ put a directory in the first empty MFD slot, in probe order from its
+        home page
+    """
+    for page in ProbePages(name, vhb["CPagedMFD"]):
+        offs = vhb["LfaMFDbase"] + page*PAGE_SIZE + 1
+        for j in range(MFD_ENTRIES_PER_PAGE):
+            if ReadByte(data, offs) == 0:
+                mfdEntry = MFD_CODEC.unpack_from(bytearray(MFD_ENTRY_SIZE))
+                mfdEntry["DirectoryName"] = LengthPrefixed(name, 13)
+                mfdEntry["LfaDirbase"] = lfaDirbase
+                mfdEntry["CPages"] = pages
+                MFD_CODEC.pack_into(mfdEntry, data, offs)
+                return
+            offs = offs + MFD_ENTRY_SIZE
+    print("Error: MFD is full", file=sys.stderr)
+    sys.exit(-1)
+
+def WriteHeaders(data, vhb, fho, dirName, name, lfaDirPage, cbFile, extents):
+    """ write a file's primary header and its alternate """
+    for headerFho in [fho, fho + vhb["AltFileHeaderPageOffset"]]:
+        fh = FILE_HEADER_CODEC.unpack_from(bytearray(512))
+        fh["FileHeaderPageNumber"] = headerFho
+        fh["sbFileName"] = LengthPrefixed(name, 51)
+        fh["sbDirectoryName"] = LengthPrefixed(dirName, 13)
+        fh["FileHeaderNumber"] = fho
+        fh["lfaDirPage"] = lfaDirPage
+        fh["cbFile"] = cbFile
+        fh["extents"] = extents
+        fh["vhb"] = vhb
+        EncodeExtents(fh)
+        UpdateFHChecksum(fh)
+        FILE_HEADER_CODEC.pack_into(fh, data, vhb["LfaFileHeadersbase"] + headerFho*512)
+
+class Allocator(object):
+    """ Hands out sectors for file data from a cursor that only moves
+        forward. With fragmentation f, each extent is split with probability
+        f, and with probability f a gap of free sectors is left after it.
+    """
+    def __init__(self, bitmap, start, limit, rand, fragmentation):
+        self.bitmap = bitmap
+        self.cursor = start
+        self.limit = limit
+        self.rand = rand
+        self.fragmentation = fragmentation
+
+    def Allocate(self, count):
+        extents = []
+        while count > 0:
+            start = self.bitmap.NextFree(self.cursor, self.limit)
+            if start >= self.limit:
+                print("Error: volume is full; use a bigger geometry or fewer or smaller files", file=sys.stderr)
+                sys.exit(-1)
+            take = min(count, self.bitmap.NextAllocated(start, self.limit) - start)
+            if (take > 1) and (len(extents) < MAX_EXTENTS - 2) and (self.rand.random() < self.fragmentation):
+                take = self.rand.randint(1, take - 1)
+            self.bitmap.Allocate(start, take)
+            extents.append( (start, take) )
+            count -= take
+            self.cursor = start + take
+            if self.rand.random() < self.fragmentation:
+                self.cursor += self.rand.randint(1, 3)
+        return extents
+
+def GenerateVolume(cylinders=80, heads=2, sectors=18, bytesPerSector=512,
+                   dirs=3, filesPerDir=20, minSize=0, maxSize=8192,
+                   sizeDist="uniform", fragmentation=0.0, seed=1, volName="Synthetic"):
+    """ Build a volume and return it as a bytearray """
+    rand = random.Random(seed)
+    size = cylinders * heads * sectors * bytesPerSector
+    diskPages = size // 512
+    data = bytearray(size)
+
+    dirNames = ["Sys"] + ["Dir%d" % i for i in range(dirs)]
+    fileNames = {"Sys": ["FileHeaders.sys", "Mfd.sys", "Log.sys"]}
+    for dirName in dirNames:
+        fileNames.setdefault(dirName, []).extend(["File%d.dat" % i for i in range(filesPerDir)])
+
+    nHeaders = sum([len(names) for names in fileNames.values()])
+    if 2*nHeaders > 0xFFFF:
+        print("Error: %d files is too many for one volume" % nHeaders, file=sys.stderr)
+        sys.exit(-1)
+
+    vhb = VHB_CODEC.unpack_from(bytearray(256))
+    for (name, value) in GeometryFields(cylinders, heads, sectors, bytesPerSector).items():
+        vhb[name] = value
+    vhb["VolName"] = LengthPrefixed(volName, 13)
+    vhb["VolPassword"] = LengthPrefixed("", 13)
+    vhb["RgLruDirEntries"] = b"\x00" * 105
+    vhb["Reserved"] = 0
+    vhb["MagicWd"] = 0x7C39
+    vhb["ClusterFactor"] = 1
+    vhb["DefaultExtend"] = 1
+    vhb["LfaInitialVHB"] = 0
+    vhb["LfaFileHeadersbase"] = 512
+    vhb["CPagesFilesHeaders"] = 2*nHeaders
+    vhb["AltFileHeaderPageOffset"] = nHeaders
+    vhb["LfaAllocBitMapbase"] = vhb["LfaFileHeadersbase"] + 2*nHeaders*512
+    vhb["CPagesAllocBitMap"] = int(math.ceil(BitmapSize(vhb)/512.0))
+    vhb["LfaLogbase"] = vhb["LfaAllocBitMapbase"] + BitmapSectors(vhb)*512
+    vhb["CPagesLog"] = LOG_PAGES
+    vhb["CPagedMFD"] = max(1, int(math.ceil(2*len(dirNames) / float(MFD_ENTRIES_PER_PAGE))))
+    vhb["LfaVHB"] = (diskPages // 2) * 512
+    vhb["LfaMFDbase"] = vhb["LfaVHB"] + 512
+
+    # directories go after the log, with room to spare for hashing
+    dirPages = {}
+    lfaDir = vhb["LfaLogbase"] + LOG_PAGES*512
+    dirBases = {}
+    for dirName in dirNames:
+        entryBytes = sum([1 + len(name) + 2 for name in fileNames[dirName]])
+        dirPages[dirName] = max(1, int(math.ceil(2*entryBytes / float(PAGE_SIZE - 2))))
+        dirBases[dirName] = lfaDir
+        lfaDir += dirPages[dirName]*512
+
+    mfdEnd = vhb["LfaMFDbase"] + vhb["CPagedMFD"]*512
+    if (lfaDir > vhb["LfaVHB"]) or (mfdEnd > size):
+        print("Error: the system areas don't fit in this geometry", file=sys.stderr)
+        sys.exit(-1)
+
+    nSectors = sectors * heads * cylinders
+    bitmap = AllocationBitmap(bytearray(BitmapSize(vhb)), nSectors, vhb["LfaAllocBitMapbase"])
+    limit = min(diskPages, nSectors)
+    bitmap.Free(0, limit)
+    bitmap.Allocate(0, lfaDir//512)
+    bitmap.Allocate(vhb["LfaVHB"]//512, 1 + vhb["CPagedMFD"])
+
+    for dirName in dirNames:
+        AddMfdEntry(data, vhb, dirName, dirBases[dirName], dirPages[dirName])
+
+    systemExtents = {
+        "FileHeaders.sys": [(vhb["LfaFileHeadersbase"], 2*nHeaders*512)],
+        "Mfd.sys": [(vhb["LfaMFDbase"], vhb["CPagedMFD"]*512)],
+        "Log.sys": [(vhb["LfaLogbase"], LOG_PAGES*512)],
+    }
+
+    pool = ContentPool(rand)
+    allocator = Allocator(bitmap, lfaDir//512, limit, rand, fragmentation)
+    mfdEntries = dict([(m["dirNameStr"], m) for m in ReadMFD(data, vhb)])
+    fho = 0
+    for dirName in dirNames:
+        for name in fileNames[dirName]:
+            if (dirName == "Sys") and (name in systemExtents):
+                extents = systemExtents[name]
+                cbFile = sum([length for (lfa, length) in extents])
+            else:
+                cbFile = FileSize(rand, minSize, maxSize, sizeDist)
+                extents = [(start*512, count*512) for (start, count) in allocator.Allocate(int(math.ceil(cbFile/512.0)))]
+                contents = MakeContents(rand, pool, cbFile)
+                offs = 0
+                for (lfa, length) in extents:
+                    chunk = contents[offs:offs+length]
+                    data[lfa:lfa+len(chunk)] = chunk
+                    offs += length
+
+            pageOffs = AddDirEntry(data, mfdEntries[dirName], vhb, name, fho)
+            if pageOffs is None:
+                print("Error: directory %s is full" % dirName, file=sys.stderr)
+                sys.exit(-1)
+            WriteHeaders(data, vhb, fho, dirName, name, pageOffs, cbFile, extents)
+            fho += 1
+
+    bitmap.Touch(0, len(bitmap.bits))
+    bitmap.WriteBack(data)
+    vhb["CFreePages"] = bitmap.CountFree()
+
+    for offset in [vhb["LfaInitialVHB"], vhb["LfaVHB"]]:
+        VHB_CODEC.pack_into(vhb, data, offset)
+        UpdateVHBFields(data, offset, {})
+
+    return data
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    _help = 'Geometry: cylinders, heads, sectors per track, bytes per sector (default: 80 2 18 512)'
+    parser.add_argument(
+        '-g', '--geometry', dest='geometry',
+        default=[80, 2, 18, 512],
+        nargs=4,
+        metavar=("CYLINDERS", "HEADS", "SECTORS", "BYTESPERSECTOR"),
+        type=int,
+        help=_help)
+
+    _help = 'Number of directories besides Sys (default: 3)'
+    parser.add_argument(
+        '-d', '--dirs', dest='dirs',
+        default=3,
+        type=int,
+        help=_help)
+
+    _help = 'Number of files in each directory (default: 20)'
+    parser.add_argument(
+        '-f', '--files', dest='files',
+        default=20,
+        type=int,
+        help=_help)
+
+    _help = 'Smallest file, in bytes (default: 0)'
+    parser.add_argument(
+        '--min-size', dest='minSize',
+        default=0,
+        type=int,
+        help=_help)
+
+    _help = 'Largest file, in bytes (default: 8192)'
+    parser.add_argument(
+        '--max-size', dest='maxSize',
+        default=8192,
+        type=int,
+        help=_help)
+
+    _help = 'How file sizes are spread between the smallest and largest (default: uniform)'
+    parser.add_argument(
+        '--size-dist', dest='sizeDist',
+        default="uniform",
+        choices=["uniform", "lognormal"],
+        help=_help)
+
+    _help = 'Chance, from 0 to 1, of splitting an extent or leaving a gap after it (default: 0)'
+    parser.add_argument(
+        '--fragmentation', dest='fragmentation',
+        default=0.0,
+        type=float,
+        help=_help)
+
+    _help = 'Random seed; the same arguments and seed give the same image (default: 1)'
+    parser.add_argument(
+        '-s', '--seed', dest='seed',
+        default=1,
+        type=int,
+        help=_help)
+
+    parser.add_argument("imagefilename")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    (cylinders, heads, sectors, bytesPerSector) = args.geometry
+    data = GenerateVolume(cylinders, heads, sectors, bytesPerSector,
+                          dirs=args.dirs, filesPerDir=args.files,
+                          minSize=args.minSize, maxSize=args.maxSize,
+                          sizeDist=args.sizeDist, fragmentation=args.fragmentation,
+                          seed=args.seed)
+
+    vol = CtosVolume(data)
+    errors = CheckDisk(vol)
+    if errors > 0:
+        print("Error: generated volume has %d errors, not writing it" % errors, file=sys.stderr)
+        sys.exit(-1)
+
+    files = FileOrder(vol)
+    extents = LayoutStats(vol, files)[0]
+    print("%d directories, %d files, %d extents, %d sectors free" % (len(vol.mfd), len(files), extents, vol.bitmap.CountFree()), file=sys.stderr)
+
+    f = open(args.imagefilename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,32 @@
     something like dd. I happened to have a couple archive SCSI tape
     drives that I found on ebay that made short work of this.
 
-    Once, you have the image, use this tool to see what's in it.
+    Once, you have the image, use this tool to see what's in it. Examples:
+
+    # list the files on the tape
+    ctostape.py tape.img
+
+    # extract every file into a directory tree, writing an index
+    ctostape.py -i tape.json tape.img extractall out
+
+    # extract one file, using the index to go straight to its records
+    ctostape.py -i tape.json -o install.sub tape.img extract Sys Install.sub
+
+    # scan a large tape with 8 processes
+    ctostape.py -j 8 -i tape.json tape.img
+
+    The tape is mapped rather than read into memory, so images of any size
+    can be scanned. After a damaged area, reading picks up again at the next
+    checkword, even if the blocks after it are no longer aligned.
 """
 
+from __future__ import print_function
+
 from ctosdisk import *
+import argparse
+import json
+import multiprocessing
+import stat
 
 TAPE_FILE_HEADER_FIELDS = [
     (0, 2, "Checksum"),
@@ -35,19 +57,139 @@ TAPE_FILE_HEADER_FIELDS = [
     (115, 4, "defaultExpansion"),
     (119, 2, "iFreeRun")]
 
+TAPE_FILE_HEADER_CODEC = StructCodec(TAPE_FILE_HEADER_FIELDS, "TapeFileHeader", ["nameStr", "passStr", "dirStr"])
+
+TAPE_HEADER_SIZE = 512
+TAPE_BLOCK_SIZE = 1536
+TAPE_BLOCK_HEADER_SIZE = 8      # checkword, 4 unknown bytes, continuation pointer
+TAPE_CHECKWORD = 0xa13d
+TAPE_RECORD_HEADER_SIZE = 6     # length, quad ID
+TAPE_RECORD_CUTOFF = 1532       # no new record starts this close to the end of a block
+
+CHECKWORD_PATTERN = re.compile(re.escape(struct.pack("<H", TAPE_CHECKWORD)))
+
+def MapTape(f):
+    """ the contents of a tape image file, mapped rather than read, since a
+        tape can be much bigger than memory
+    """
+    st = os.fstat(f.fileno())
+    if stat.S_ISREG(st.st_mode) and (st.st_size == 0):
+        # can't map an empty file, but there's nothing to read either
+        return b""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError) as e:
+        print("Error: can't map %s (%s); copy the tape to a regular file first, e.g. with dd" % (f.name, e), file=sys.stderr)
+        sys.exit(-1)
+
+def IsCheckword(data, offs):
+    return (offs + 2 <= len(data)) and (struct.unpack_from("<H", data, offs)[0] == TAPE_CHECKWORD)
+
+def FindResync(data, offs):
+    """ After a bad block at offs, find where blocks start again: the next
+        checkword at a block boundary, or one that isn't but is followed by
+        another a block later. Returns None if there is neither.
+    """
+    for m in CHECKWORD_PATTERN.finditer(data, offs + 1):
+        candidate = m.start()
+        if (candidate - offs) % TAPE_BLOCK_SIZE == 0:
+            return candidate
+        if IsCheckword(data, candidate + TAPE_BLOCK_SIZE) or (candidate + TAPE_BLOCK_SIZE == len(data)):
+            return candidate
+    return None
+
+def TapeBlocks(data):
+    """ Walk the blocks of a tape. Yields (blockNum, offs, message) for each
+        one, where message is None for a good block and otherwise says what
+        is wrong with it.
+    """
+    tapeLen = len(data)
+    offs = TAPE_HEADER_SIZE
+    blockNum = 0
+    resync = None
+    while offs < tapeLen:
+        if offs + TAPE_BLOCK_SIZE > tapeLen:
+            yield (blockNum, offs, "Short block %d at end of tape, offs=%X, len=%d" % (blockNum, offs, tapeLen - offs))
+            break
+
+        checkWord = struct.unpack_from("<H", data, offs)[0]
+        if (checkWord == TAPE_CHECKWORD):
+            yield (blockNum, offs, None)
+            offs = offs + TAPE_BLOCK_SIZE
+        else:
+            yield (blockNum, offs, "Likely bad block %d, checkword=%d, offs=%X, tapeLen=%X" % (blockNum, checkWord, offs, tapeLen))
+
+            if (resync is None) or (resync <= offs):
+                resync = FindResync(data, offs)
+            if (resync is not None) and ((resync - offs) % TAPE_BLOCK_SIZE != 0):
+                blockNum = blockNum + 1
+                yield (blockNum, offs, "Resynchronized at offs=%X, %d bytes after offs=%X" % (resync, resync - offs, offs))
+                offs = resync
+            else:
+                offs = offs + TAPE_BLOCK_SIZE
+
+        #print("%d %d %d" % (blockNum, checkWord, offs))
+
+        blockNum = blockNum + 1
+
+def ExtractFileName(rootDir, dirName, fileName, log):
+    """ Where to extract a file to, creating its directory, or None for the
+        names "." and "..", which would land outside their directory
+    """
+    if dirName == "." or dirName == "..":
+        print("Skipping directory %s" % dirName, file=log)
+        return None
+    if fileName == "." or fileName == "..":
+        print("Skipping file %s" % fileName, file=log)
+        return None
+    destDir = os.path.join(rootDir, makeSafeFileName(dirName))
+    if not os.path.exists(destDir):
+        os.makedirs(destDir)
+    return os.path.join(destDir, makeSafeFileName(fileName))
+
+def AddPiece(pieces, offs, length):
+    """ add a run of tape bytes to a list of [offset, length], merging it
+        with the last one if they are adjacent
+    """
+    if pieces and (pieces[-1][0] + pieces[-1][1] == offs):
+        pieces[-1][1] += length
+    else:
+        pieces.append([offs, length])
+
+def CheckFileSize(cur, log):
+    if cur["written"] < cur["size"]:
+        print("Short file %s/%s, %d of %d bytes" % (cur["dir"], cur["file"], cur["written"], cur["size"]), file=log)
+
 class TapeReader():
-    def __init__(self):
+    """ Reads a tape, printing the name of each file it finds. The data
+        records that follow a file header are the file's contents, up to
+        cbFile bytes. Every file is added to Files, with the tape offsets of
+        its data, and is written under extractDir if one is given. If only
+        is a (directory, name) pair, only that file is written, to the
+        stream out.
+    """
+    def __init__(self, extractDir=None, only=None, out=None, log=sys.stdout):
         self.TapeHeader = {}
         self.RecLen = None
         self.RecQuadID = None
-        self.RecBuf = ""
+        self.RecBuf = bytearray()
+        self.RecSize = 0
+        self.RecPieces = []
         self.AbsPos = 0
         self.RecStart = 0
         self.Started = False
+        self.ExtractDir = extractDir
+        self.Only = only
+        self.ListFiles = (only is None)
+        self.Out = out
+        self.Log = log
+        self.Files = []
+        self.CurFile = None
+        self.CurOut = None
 
     def TryDecodeFileHeader(self, data):
         if self.RecLen == 256:
-            fh = DecodeStructAsDict(data, TAPE_FILE_HEADER_FIELDS)
+            fh = TAPE_FILE_HEADER_CODEC.unpack_from(data)
 
             nameLen = ord(fh["sbFileName"][0])
             if (nameLen<1) or (nameLen>50):
@@ -74,101 +216,419 @@ class TapeReader():
 
 
     def HandleRecord(self):
-        #print "Record len=%d, quadID=%08X, AbsPos=%X. RecStart=%X" % (self.RecLen, self.RecQuadID, self.AbsPos, self.RecStart)
-        fh = self.TryDecodeFileHeader(self.RecBuf[6:])
+        #print("Record len=%d, quadID=%08X, AbsPos=%X. RecStart=%X" % (self.RecLen, self.RecQuadID, self.AbsPos, self.RecStart))
+        fh = self.TryDecodeFileHeader(bytes(self.RecBuf[6:]))
         if fh is not None:
-            print "%s/%s" % (fh["dirStr"], fh["nameStr"])
+            if self.ListFiles:
+                print("%s/%s" % (fh["dirStr"], fh["nameStr"]), file=self.Log)
+            self.StartFile(fh)
+        elif self.CurFile is not None:
+            self.HandleFileData()
+
+    def StartFile(self, fh):
+        self.FinishFile()
+        self.CurFile = {"dir": fh["dirStr"], "file": fh["nameStr"], "size": fh["cbFile"], "written": 0, "pieces": []}
+        self.Files.append(self.CurFile)
+
+        if self.Only is not None:
+            if (fh["dirStr"].lower(), fh["nameStr"].lower()) == self.Only:
+                self.CurOut = self.Out
+                self.Only = None
+        elif self.ExtractDir is not None:
+            destFileName = ExtractFileName(self.ExtractDir, fh["dirStr"], fh["nameStr"], self.Log)
+            if destFileName is not None:
+                self.CurOut = open(destFileName, "wb")
+
+    def HandleFileData(self):
+        """ the record just read is the next piece of the current file """
+        cur = self.CurFile
+        length = min(self.RecLen, cur["size"] - cur["written"])
+        if length <= 0:
+            return
 
+        if self.CurOut is not None:
+            self.CurOut.write(bytes(self.RecBuf[6:6+length]))
+
+        # where the record's data is on the tape, skipping its header
+        skip = TAPE_RECORD_HEADER_SIZE
+        for (offs, pieceLen) in self.RecPieces:
+            if skip >= pieceLen:
+                skip -= pieceLen
+                continue
+            take = min(pieceLen - skip, length)
+            AddPiece(cur["pieces"], offs + skip, take)
+            length -= take
+            cur["written"] += take
+            skip = 0
+            if length == 0:
+                break
+
+    def FinishFile(self):
+        cur = self.CurFile
+        if cur is None:
+            return
+        if cur["dir"] is not None:
+            CheckFileSize(cur, self.Log)
+        if (self.CurOut is not None) and (self.CurOut is not self.Out):
+            self.CurOut.close()
+        self.CurOut = None
+        self.CurFile = None
 
     def StartNewRecord(self):
         self.Started = True
-        self.RecBuf = ""
+        self.RecBuf = bytearray()
+        self.RecSize = 0
+        self.RecPieces = []
         self.RecLen = None
         self.RecQuadID = None
         self.RecStart = self.AbsPos + 1
 
-    def HandleByte(self, b):
-        self.RecBuf = self.RecBuf + b
-        if len(self.RecBuf) == 2:
-            self.RecLen = struct.unpack_from("<H", self.RecBuf, 0)[0]
-            #print "RecLen %d, AbsPos=%X" % (self.RecLen, self.AbsPos)
-            if self.RecLen == 0:
-                print "XXX Bad Block (RecLen=0) At RecStart=%X" % (self.AbsPos-2)
-            if self.RecLen>512:
-                print "XXX Bad Block (RecLen=%d) At RecStart=%X" % (self.AbsPos-2, self.RecLen)
-        elif len(self.RecBuf) == 6:
-            self.RecQuadID = struct.unpack_from("<L", self.RecBuf, 2)[0]
-        elif (self.RecLen!=None) and (len(self.RecBuf) == self.RecLen+6):
-            self.HandleRecord()
-            self.StartNewRecord()
+    def BytesWanted(self):
+        """ how many bytes can be taken before the record changes state """
+        if self.RecSize < 2:
+            # one at a time, so the end of block cutoff sees each of them
+            return 1
+        elif self.RecSize < TAPE_RECORD_HEADER_SIZE:
+            return TAPE_RECORD_HEADER_SIZE - self.RecSize
+        elif self.RecSize < self.RecLen + TAPE_RECORD_HEADER_SIZE:
+            return self.RecLen + TAPE_RECORD_HEADER_SIZE - self.RecSize
+        else:
+            # a zero length record never completes; it runs on until the
+            # start of the next block
+            return None
+
+    def HandleBytes(self, block, blockOffs, end, blockPos, cutoff=None):
+        """ Take bytes blockOffs..end of a block, blockPos being the block's
+            offset in the tape, slicing out as much of the current record at
+            once as it can. If cutoff is given, stop once a record has ended
+            at or after it. Returns the offset reached.
+        """
+        while blockOffs < end:
+            wanted = self.BytesWanted()
+            if wanted is None:
+                take = end - blockOffs
+            else:
+                take = min(wanted, end - blockOffs)
+                self.RecBuf += block[blockOffs:blockOffs+take]
+                AddPiece(self.RecPieces, blockPos + blockOffs, take)
+            self.RecSize += take
+            blockOffs += take
+            self.AbsPos = blockPos + blockOffs - 1
+
+            if take == wanted:
+                if self.RecSize == 2:
+                    self.RecLen = struct.unpack_from("<H", bytes(self.RecBuf), 0)[0]
+                    #print("RecLen %d, AbsPos=%X" % (self.RecLen, self.AbsPos))
+                    if self.RecLen == 0:
+                        print("XXX Bad Block (RecLen=0) At RecStart=%X" % (self.AbsPos-2), file=self.Log)
+                    if self.RecLen>512:
+                        print("XXX Bad Block (RecLen=%d) At RecStart=%X" % (self.AbsPos-2, self.RecLen), file=self.Log)
+                elif self.RecSize == TAPE_RECORD_HEADER_SIZE:
+                    self.RecQuadID = struct.unpack_from("<L", bytes(self.RecBuf), 2)[0]
+                elif (self.RecLen!=None) and (self.RecSize == self.RecLen + TAPE_RECORD_HEADER_SIZE):
+                    self.HandleRecord()
+                    self.StartNewRecord()
+
+            # Don't start a new record if it would be empty
+            if (cutoff is not None) and (self.RecLen == None) and (blockOffs>=cutoff):
+                break
+
+        self.AbsPos = blockPos + blockOffs
+        return blockOffs
 
     def ForceFinishRecord(self):
         if not self.Started:
             return
-        if len(self.RecBuf) < 6:
-            #print "Non-record bytes at, RecStart=%X" % self.RecStart
+        if self.RecSize < 6:
+            #print("Non-record bytes at, RecStart=%X" % self.RecStart)
             self.StartNewRecord()
-        elif len(self.RecBuf) != self.RecLen:
-            print "Short record, RecStart=%X, len=%d, RecLen=%X" % (self.RecStart, len(self.RecBuf), self.RecLen)
+        elif self.RecSize != self.RecLen:
+            print("Short record, RecStart=%X, len=%d, RecLen=%X" % (self.RecStart, self.RecSize, self.RecLen), file=self.Log)
             self.StartNewRecord()
 
-    def HandleBlock(self, data, offs):
-        pointer = struct.unpack_from("<H", data, offs+6)[0]
-        blockOffs = 8
+    def HandleBlockStart(self, block, offs):
+        """ Handle the start of a block: the rest of the record that the
+            previous block ended in. Returns the offset of what follows.
+        """
+        pointer = struct.unpack_from("<H", block, 6)[0]
+        blockOffs = TAPE_BLOCK_HEADER_SIZE
         self.AbsPos = offs + blockOffs
         if pointer>0:
-            for i in range(0, pointer):
-                self.HandleByte(data[offs+blockOffs+i])
-                self.AbsPos += 1
-            blockOffs = pointer+8
+            if blockOffs + pointer > TAPE_BLOCK_SIZE:
+                print("XXX Bad Block (pointer=%d) At offs=%X" % (pointer, offs), file=self.Log)
+                pointer = TAPE_BLOCK_SIZE - blockOffs
+            self.HandleBytes(block, blockOffs, blockOffs + pointer, offs)
+            blockOffs = pointer + TAPE_BLOCK_HEADER_SIZE
             self.AbsPos = offs + blockOffs
 
         self.ForceFinishRecord()
+        return blockOffs
+
+    def HandleBlock(self, block, offs, skipStart=False):
+        """ Handle one whole block, offs being its offset in the tape. With
+            skipStart, the start of the block has already been handled by
+            whoever read the block before it.
+        """
+        if skipStart:
+            pointer = min(struct.unpack_from("<H", block, 6)[0], TAPE_BLOCK_SIZE - TAPE_BLOCK_HEADER_SIZE)
+            blockOffs = pointer + TAPE_BLOCK_HEADER_SIZE
+            self.AbsPos = offs + blockOffs
+            self.StartNewRecord()
+        else:
+            blockOffs = self.HandleBlockStart(block, offs)
 
-        #print "offs=%X, blockOffs=%X" % (offs, blockOffs)
-        while blockOffs<1536:
-            self.HandleByte(data[offs+blockOffs])
-            blockOffs += 1
-            self.AbsPos += 1
-
-            # Don't start a new record if it would be empty
-            if (self.RecLen == None) and (blockOffs>=1532):
-                return
+        #print("offs=%X, blockOffs=%X" % (offs, blockOffs))
+        self.HandleBytes(block, blockOffs, TAPE_BLOCK_SIZE, offs, cutoff=TAPE_RECORD_CUTOFF)
 
-    def ReadTape(self, data):
+    def ReadTape(self, f):
+        """ Read a tape image from the file object f """
+        data = MapTape(f)
         self.tapeHeader = {"name": data[0:55],
                     "date": data[55:80],
                     "vol": data[80:160]}
 
-        offs = 512
-        tapeLen = len(data)
-        blockNum = 0
-        while (offs<tapeLen):
-            checkWord = struct.unpack_from("<H", data, offs)[0]
-
-            if (checkWord != 0xa13d):
-                print "Likely bad block %d, checkword=%d, offs=%X, tapeLen=%X" % (blockNum, checkWord, offs, tapeLen)
+        for (blockNum, offs, message) in TapeBlocks(data):
+            if message is not None:
+                print(message, file=self.Log)
             else:
-                self.HandleBlock(data, offs)
+                self.HandleBlock(data[offs:offs+TAPE_BLOCK_SIZE], offs)
 
-            #print("%d %d %d" % (blockNum, checkWord, offs))
+        self.FinishFile()
+
+class LogBuffer(object):
+    """ collects what a worker prints, to be printed in tape order """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+def ScanChunk(job):
+    """ Parse a run of blocks in a worker process. Every chunk but the first
+        starts with a good block, whose start belongs to the chunk before.
+        Returns (output, data records before the chunk's first file header,
+        files).
+    """
+    (fn, blocks, nextOffs, first) = job
+    f = open(fn, "rb")
+    data = MapTape(f)
+
+    reader = TapeReader(log=LogBuffer())
+    lead = None
+    if not first:
+        reader.Started = True
+        # collects the data records of whatever file the last chunk ended in
+        lead = {"dir": None, "file": None, "size": sys.maxsize, "written": 0, "pieces": []}
+        reader.CurFile = lead
+
+    for (i, (blockNum, offs, message)) in enumerate(blocks):
+        if message is not None:
+            print(message, file=reader.Log)
+        else:
+            reader.HandleBlock(data[offs:offs+TAPE_BLOCK_SIZE], offs, skipStart=(i == 0) and (not first))
+
+    # finish off the record this chunk ends in
+    if nextOffs is not None:
+        reader.HandleBlockStart(data[nextOffs:nextOffs+TAPE_BLOCK_SIZE], nextOffs)
+
+    f.close()
+    return (reader.Log.getvalue(), lead, reader.Files)
+
+def ContinueFile(cur, lead):
+    """ give cur the data records a later chunk found before its first header """
+    for (offs, length) in lead["pieces"]:
+        take = min(length, cur["size"] - cur["written"])
+        if take <= 0:
+            break
+        AddPiece(cur["pieces"], offs, take)
+        cur["written"] += take
+
+def ScanTapeParallel(fn, jobs, log=sys.stdout):
+    """ Scan a tape with a pool of worker processes. The blocks are found
+        first, then split into chunks that are parsed in parallel and
+        stitched back together. Returns the files found, as TapeReader.Files.
+    """
+    f = open(fn, "rb")
+    blocks = list(TapeBlocks(MapTape(f)))
+    f.close()
+
+    good = [i for (i, block) in enumerate(blocks) if block[2] is None]
+    nChunks = max(1, min(len(good), jobs*4))
+    starts = [0] + [good[(k * len(good)) // nChunks] for k in range(1, nChunks)]
+    starts = sorted(set(starts))
+    ends = starts[1:] + [len(blocks)]
+
+    work = []
+    for (k, (start, end)) in enumerate(zip(starts, ends)):
+        nextOffs = blocks[end][1] if end < len(blocks) else None
+        work.append( (fn, blocks[start:end], nextOffs, k == 0) )
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(ScanChunk, work)
+    finally:
+        pool.close()
+        pool.join()
+
+    # the last file of a chunk carries on until a later chunk has a header
+    files = []
+    for (output, lead, chunkFiles) in results:
+        if files:
+            ContinueFile(files[-1], lead)
+            if chunkFiles:
+                CheckFileSize(files[-1], log)
+        log.write(output)
+        files.extend(chunkFiles)
+    if files:
+        CheckFileSize(files[-1], log)
+    return files
+
+def WriteIndex(fn, tapeFn, files):
+    index = {"tape": os.path.basename(tapeFn),
+             "files": [{"dir": entry["dir"],
+                        "file": entry["file"],
+                        "size": entry["size"],
+                        "pieces": entry["pieces"]} for entry in files]}
+    f = open(fn, "w")
+    json.dump(index, f)
+    f.close()
+
+def ReadIndex(fn):
+    return json.load(open(fn, "r"))["files"]
+
+def FindIndexEntry(files, dirName, fileName):
+    for entry in files:
+        if (entry["dir"].lower() == dirName.lower()) and (entry["file"].lower() == fileName.lower()):
+            return entry
+    return None
+
+def ExtractIndexed(f, entry, out):
+    """ Copy a file's data straight from its offsets on the tape. Returns the
+        number of bytes written.
+    """
+    written = 0
+    for (offs, length) in entry["pieces"]:
+        f.seek(offs)
+        chunk = f.read(length)
+        out.write(chunk)
+        written += len(chunk)
+    return written
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    _help = 'Index file to write while scanning, or to read for extract'
+    parser.add_argument(
+        '-i', '--index', dest='index',
+        default="",
+        action="store",
+        type=str,
+        help=_help)
+
+    _help = 'Number of processes to scan the tape with (default: 1)'
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs',
+        default=1,
+        type=int,
+        help=_help)
+
+    _help = 'Write extract output to a filename (default: write to stdout)'
+    parser.add_argument(
+        '-o', '--output', dest='output',
+        default="",
+        action="store",
+        type=str,
+        help=_help)
+
+    parser.add_argument("imagefilename")
+    parser.add_argument("command", nargs="?", default="list", choices=[
+        "list",
+        "extractall",
+        "extract",
+    ])
+    parser.add_argument("args", nargs="*")
+
+    return parser.parse_args()
+
+def getOutputFile(args):
+    if args.output == "":
+        return getattr(sys.stdout, "buffer", sys.stdout)
+    return open(args.output, "wb")
+
+def scan(args, reader):
+    if args.jobs > 1:
+        files = ScanTapeParallel(args.imagefilename, args.jobs, log=reader.Log)
+    else:
+        f = open(args.imagefilename, "rb")
+        reader.ReadTape(f)
+        f.close()
+        files = reader.Files
+    if args.index:
+        WriteIndex(args.index, args.imagefilename, files)
+    return files
+
+def extractAll(args):
+    if len(args.args)<1:
+        print("Error: required argument <destdir> is missing", file=sys.stderr)
+        sys.exit(-1)
 
-            offs = offs + 1536
-            blockNum = blockNum + 1
+    rootDir = args.args[0]
+
+    if args.jobs <= 1:
+        scan(args, TapeReader(extractDir=rootDir))
+        return
+
+    # scan in parallel, then copy each file straight from where it was found
+    files = scan(args, TapeReader())
+    f = open(args.imagefilename, "rb")
+    for entry in files:
+        destFileName = ExtractFileName(rootDir, entry["dir"], entry["file"], sys.stderr)
+        if destFileName is None:
+            continue
+        out = open(destFileName, "wb")
+        ExtractIndexed(f, entry, out)
+        out.close()
+    f.close()
+
+def extract(args):
+    if len(args.args)<2:
+        print("Error: required argument <directory> and <filename> are missing", file=sys.stderr)
+        sys.exit(-1)
 
-def main():
-    if len(sys.argv)<2:
-        print "syntax: ctostape <image-name>"
+    (dirName, fileName) = (args.args[0], args.args[1])
+
+    if args.index and os.path.exists(args.index):
+        entry = FindIndexEntry(ReadIndex(args.index), dirName, fileName)
+        if entry is None:
+            print("Error: File Not Found: %s/%s" % (dirName, fileName), file=sys.stderr)
+            sys.exit(-1)
+        f = open(args.imagefilename, "rb")
+        written = ExtractIndexed(f, entry, getOutputFile(args))
+        f.close()
+        if written != entry["size"]:
+            print("Short file %s/%s, %d of %d bytes" % (dirName, fileName, written, entry["size"]), file=sys.stderr)
+        return
+
+    # no index yet; scan the tape for the file, and write the index if asked
+    args.jobs = 1
+    reader = TapeReader(only=(dirName.lower(), fileName.lower()), out=getOutputFile(args), log=sys.stderr)
+    scan(args, reader)
+    if FindIndexEntry(reader.Files, dirName, fileName) is None:
+        print("Error: File Not Found: %s/%s" % (dirName, fileName), file=sys.stderr)
         sys.exit(-1)
 
-    fn = sys.argv[1]
+def main():
+    args = parse_args()
 
-    data = open(fn).read()
-    TapeReader().ReadTape(data)
+    if args.command == "list":
+        scan(args, TapeReader())
+    elif args.command == "extractall":
+        extractAll(args)
+    elif args.command == "extract":
+        extract(args)
 
 if __name__ == "__main__":
     main()
-
-
-
-
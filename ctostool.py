@@ -12,6 +12,36 @@ Tool for inspecting CTOS floppy images. Examples:
 
     # extract a file to stdout
     ctostool.py test.img extract Sys Install.sub
+
+    # apply a script of replace/delete operations, saving once at the end
+    ctostool.py test.img batch changes.txt
+
+    # copy a volume into a smaller geometry, packing its sectors down
+    ctostool.py test.img compact 80 2 8 512 > small.img
+
+    # convert to another geometry in one pass, as a track-ordered image
+    # with 2:1 interleave
+    ctostool.py --interleave 2 test.img convert 90 2 16 256 > new.img
+
+    # make every file contiguous, laid out in directory order
+    ctostool.py test.img defrag
+
+    # sha256 of every file, or of the files in some directories
+    ctostool.py test.img hash
+    ctostool.py test.img hash Sys
+
+    # extract into a content-addressed store shared between images,
+    # hardlinking each extracted file to its one stored copy
+    ctostool.py --store /blobs test.img extractall out
+
+    # what changed between two images: sectors, metadata, directories, files
+    ctostool.py before.img diff after.img
+
+    # catalog every image under a directory tree into a database
+    ctostool.py catalog.db catalog /images
+
+    # which cataloged images contain a file, by name or by sha256
+    ctostool.py catalog.db find Install.Sub
 """
 
 from __future__ import print_function
@@ -19,10 +49,22 @@ from __future__ import print_function
 from ctosdisk import *
 import argparse
 import ConfigParser
+import errno
+import hashlib
+import json
+import shlex
+import shutil
+import sqlite3
 import sys
 import string
+import tempfile
+import threading
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 DEFAULT_CONFIG_FILE = "ctostool.conf"
+DEFAULT_JOBS = 4
 
 def hex_escape(s):
     printable = string.ascii_letters + string.digits + string.punctuation + ' '
@@ -64,6 +106,48 @@ def parse_args():
         action="store_true",
         help=_help)
 
+    _help = 'fsync the image after writing changes back to it'
+    parser.add_argument(
+        '--fsync', dest='fsync',
+        default=False,
+        action="store_true",
+        help=_help)
+
+    _help = 'Run a full disk check after replace/delete, instead of checking only what changed'
+    parser.add_argument(
+        '--fullcheck', dest='fullcheck',
+        default=False,
+        action="store_true",
+        help=_help)
+
+    _help = 'setgeometry changes the image in place, instead of writing a new image'
+    parser.add_argument(
+        '--inplace', dest='inplace',
+        default=False,
+        action="store_true",
+        help=_help)
+
+    _help = 'convert writes the sectors of each track in the order of this interleave'
+    parser.add_argument(
+        '--interleave', dest='interleave',
+        default=None,
+        type=int,
+        help=_help)
+
+    _help = 'Number of files extractall writes, or images catalog reads, in parallel (default: %d)' % DEFAULT_JOBS
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs',
+        default=DEFAULT_JOBS,
+        type=int,
+        help=_help)
+
+    _help = 'listdir prints only file names, without reading any file headers'
+    parser.add_argument(
+        '-n', '--names', dest='names',
+        default=False,
+        action="store_true",
+        help=_help)
+
     _help = 'Write output to a filename (default: write to stdout)'
     parser.add_argument(
         '-o', '--output', dest='output',
@@ -72,6 +156,14 @@ def parse_args():
         type=str,
         help=_help)
 
+    _help = 'extractall writes each distinct file once into this content-addressed store, and hardlinks to it'
+    parser.add_argument(
+        '--store', dest='store',
+        default="",
+        action="store",
+        type=str,
+        help=_help)
+
     parser.add_argument("imagefilename")
     parser.add_argument("command", choices=[
         "dump",
@@ -84,6 +176,14 @@ def parse_args():
         "replace",
         "chkdsk",
         "delete",
+        "batch",
+        "compact",
+        "convert",
+        "defrag",
+        "hash",
+        "diff",
+        "catalog",
+        "find",
     ])
     parser.add_argument("args", nargs="*")
 
@@ -91,39 +191,27 @@ def parse_args():
 
     return args
 
-def makeSafeFileName(fn):
-    return fn.replace(">", "_").replace("/", "_")
-
 def getOutputFile(args):
     if args.output == "":
         return sys.stdout
     return open(args.output, "wb")
 
-def loadFile(args):
-    f = open(args.imagefilename, "rb")
-    data = f.read()
-    f.close()
-    data = bytearray(data)
-    return data
-
-def saveFile(args, data):
-    f = open(args.imagefilename, "wb")
-    f.write(data)
-    f.close()
-
-def openFile(data, dirName, fileName, vhb=None, mfd=None, dir=None):
-    if not vhb:
-        vhb=LoadVHB(data, vhb)
-    if not mfd:
-        mfd=ReadMFD(data, vhb=vhb)
-    if not dir:
-        dir=ReadDir(data, dirName, vhb=vhb, mfd=mfd)
-
-    if dir is None:
+def loadFile(args, mutable=False):
+    return OpenImage(args.imagefilename, copyOnWrite=mutable)
+
+def loadVolume(args, mutable=False):
+    return CtosVolume(loadFile(args, mutable))
+
+def saveVolume(args, vol):
+    # only the pages the volume wrote to go back to the image
+    vol.WriteBack(args.imagefilename, sync=args.fsync)
+
+def openFile(vol, dirName, fileName):
+    if vol.FindDir(dirName) is None:
         print("Error: Dir Not Found: %s" % dirName, file=sys.stderr)
         sys.exit(-1)
 
-    fh = FindFile(dir, fileName)
+    fh = vol.FindFile(dirName, fileName)
 
     if fh is None:
         print("Error: File Not Found: %s" % fileName, file=sys.stderr)
@@ -132,24 +220,25 @@ def openFile(data, dirName, fileName, vhb=None, mfd=None, dir=None):
     return fh
 
 def chkdsk(args):
-    data = loadFile(args)
-    errors = CheckDisk(data)
+    vol = loadVolume(args)
+    errors = CheckDisk(vol)
     print("Checkdisk Complete, %d errors" % errors)
 
 
 def dump(args):
-    data = loadFile(args)
+    vol = loadVolume(args)
+    data = vol.data
     print("== Backup VHB")
     PrintStruct(data, VHB_FIELDS)
 
     print("\n== Active VHB")
-    print(LoadVHB(data, which="backup")["LfaVHB"])
-    PrintStruct(data[LoadVHB(data, which="backup")["LfaVHB"]:], VHB_FIELDS)
+    print(vol.backupVhb["LfaVHB"])
+    PrintStruct(data, VHB_FIELDS, vol.backupVhb["LfaVHB"])
 
     VerifyVHBChecksum(data)
     VerifyActiveVHB(data)
 
-    DumpEverything(data)
+    DumpEverything(vol)
 
 
 def listdir(args):
@@ -157,17 +246,20 @@ def listdir(args):
         print("Error: required argument <directory> is missing", file=sys.stderr)
         sys.exit(-1)
 
-    data = loadFile(args)
+    vol = loadVolume(args)
 
-    VerifyVHBChecksum(data)
+    VerifyVHBChecksum(vol.data)
 
     for arg in args.args:
-        dirEntries = ReadDir(data, arg)
-        PrintDir(dirEntries)
+        dirEntries = vol.ReadDir(arg)
+        if args.names:
+            PrintDirNames(dirEntries)
+        else:
+            PrintDir(dirEntries)
 
 def dumpbitmap(args):
-    data = loadFile(args)
-    bitmap = ReadAllocationBitmap(data)
+    vol = loadVolume(args)
+    bitmap = vol.bitmap
     for i, bit in enumerate(bitmap):
         print("%d:%d" % (i, bit))
 
@@ -176,58 +268,118 @@ def extract(args):
         print("Error: required argument <directory> and <filename> are missing", file=sys.stderr)
         sys.exit(-1)
 
-    data = loadFile(args)
-    fh = openFile(data, args.args[0], args.args[1])
-
-    contents = RetrieveContents(data, fh)
+    vol = loadVolume(args)
+    fh = openFile(vol, args.args[0], args.args[1])
 
     if args.escape:
-        contents = hex_escape(contents)
-
-    getOutputFile(args).write(contents)
+        contents = hex_escape(RetrieveContents(vol.data, fh))
+        getOutputFile(args).write(contents)
+    else:
+        WriteContents(vol.data, fh, getOutputFile(args))
 
 def replace(args):
     if len(args.args)<3:
         print("Error: required argument <directory> and <filename> and <srcfile> are missing", file=sys.stderr)
         sys.exit(-1)
 
-    data = loadFile(args)
-    fh = openFile(data, args.args[0], args.args[1])
-
-    bitmap = ReadAllocationBitmap(data)
+    vol = loadVolume(args, mutable=True)
+    fh = openFile(vol, args.args[0], args.args[1])
 
     srcData = open(args.args[2], "rb").read()
-    ReplaceContents(data, fh, bitmap, srcData)
+    ReplaceContents(vol, fh, srcData, fullCheck=args.fullcheck)
 
-    saveFile(args, data)
+    saveVolume(args, vol)
 
 def delete(args):
     if len(args.args)<2:
         print("Error: required argument <directory> and <filename> are missing", file=sys.stderr)
         sys.exit(-1)
 
-    data = loadFile(args)
-    fh = openFile(data, args.args[0], args.args[1])
+    vol = loadVolume(args, mutable=True)
+    fh = openFile(vol, args.args[0], args.args[1])
 
-    bitmap = ReadAllocationBitmap(data)
+    Delete(vol, args.args[0], fh, fullCheck=args.fullcheck)
 
-    Delete(data, args.args[0], fh, bitmap)
+    saveVolume(args, vol)
 
-    saveFile(args, data)
-    
-def extractAll(args):
-    if len(args.args)<1:
-        print("Error: required argument <destdir> is missing", file=sys.stderr)
-        sys.exit(-1)
+BATCH_OPS = {"replace": 3, "delete": 2}
 
-    rootDir = args.args[0]
+def readBatch(fn):
+    """ Read a batch script. Either one operation per line:
+
+            replace <directory> <filename> <srcfile>
+            delete <directory> <filename>
+
+        with blank lines and lines starting with # ignored, or a JSON list
+        whose items are lists in the same form or objects with "op", "dir",
+        "file" and (for replace) "src" keys.
+    """
+    text = open(fn, "r").read()
+    ops = []
+    if text.lstrip().startswith("["):
+        for item in json.loads(text):
+            if isinstance(item, dict):
+                op = [item.get("op"), item.get("dir"), item.get("file")]
+                if item.get("op") == "replace":
+                    op.append(item.get("src"))
+            else:
+                op = list(item)
+            ops.append([str(x) for x in op])
+    else:
+        for line in text.splitlines():
+            line = line.strip()
+            if (not line) or line.startswith("#"):
+                continue
+            ops.append(shlex.split(line))
+
+    for (i, op) in enumerate(ops):
+        if (op[0] not in BATCH_OPS) or (len(op) != BATCH_OPS[op[0]] + 1):
+            print("Error: batch operation %d is not valid: %s" % (i+1, " ".join(op)), file=sys.stderr)
+            sys.exit(-1)
 
-    data = loadFile(args)
+    return ops
 
-    vhb = LoadVHB(data)
-    mfd = ReadMFD(data, vhb=vhb)
+def batch(args):
+    if len(args.args)<1:
+        print("Error: required argument <scriptfile> is missing", file=sys.stderr)
+        sys.exit(-1)
+
+    ops = readBatch(args.args[0])
+
+    # The image is a private copy-on-write mapping, so if anything below
+    # fails before saveVolume, the image file is left exactly as it was.
+    vol = loadVolume(args, mutable=True)
+    vol.BeginBatch()
+
+    for (i, op) in enumerate(ops):
+        print("%s %s" % (op[0], " ".join(op[1:])))
+        try:
+            fh = openFile(vol, op[1], op[2])
+            if op[0] == "replace":
+                srcData = open(op[3], "rb").read()
+                ReplaceContents(vol, fh, srcData)
+            elif op[0] == "delete":
+                Delete(vol, op[1], fh)
+        except (SystemExit, EnvironmentError) as e:
+            if isinstance(e, EnvironmentError):
+                print("Error: %s" % e, file=sys.stderr)
+            print("Error: batch operation %d failed, no changes were saved" % (i+1), file=sys.stderr)
+            sys.exit(-1)
+
+    errors = vol.Commit(fullCheck=args.fullcheck)
+    if errors != 0:
+        print("Error: disk check failed after batch, no changes were saved", file=sys.stderr)
+        sys.exit(-1)
 
-    for mfdEntry in mfd:
+    saveVolume(args, vol)
+    
+def planExtractAll(vol, rootDir):
+    """ Walk the volume once, creating the destination directories, and
+        return a list of (destFileName, extents, cbFile, dirName, fileName)
+        for every file.
+    """
+    plan = []
+    for mfdEntry in vol.mfd:
         dirName = mfdEntry["dirNameStr"]
         if dirName == "." or dirName == "..":
             print("Skipping directory %s" % dirName, file=sys.stderr)
@@ -237,27 +389,164 @@ def extractAll(args):
         if not os.path.exists(destDir):
             os.makedirs(destDir)
 
-        dirEntries = ReadDir(data, dirName, vhb=vhb, mfd=mfd)
-        for dirEntry in dirEntries:
+        for dirEntry in vol.ReadDir(dirName):
             fileName = dirEntry["name"]
             if fileName == "." or fileName=="..":
-                print("Skipping file %s % fileName", file=sys.stderr)
-                cotninue
-
-            fh = openFile(data, dirName, fileName, vhb=vhb, mfd=mfd, dir=dirEntries)
-            contents = RetrieveContents(data, fh)
+                print("Skipping file %s" % fileName, file=sys.stderr)
+                continue
 
+            fh = dirEntry.fh
+            if fh is None:
+                continue
             destFileName = os.path.join(destDir, makeSafeFileName(fileName))
+            plan.append( (destFileName, fh["extents"], fh["cbFile"], dirName, fileName) )
+    return plan
+
+def extractAll(args):
+    if len(args.args)<1:
+        print("Error: required argument <destdir> is missing", file=sys.stderr)
+        sys.exit(-1)
+
+    rootDir = args.args[0]
+
+    vol = loadVolume(args)
+    plan = planExtractAll(vol, rootDir)
+
+    printLock = threading.Lock()
+    manifest = {}
+
+    def extractOne(item):
+        (destFileName, extents, cbFile, dirName, fileName) = item
+        if args.store:
+            (sha256, size, written) = storeBlob(args.store, vol.data, extents, cbFile)
+            linkOrCopy(blobFileName(args.store, sha256), destFileName)
+            manifest["%s/%s" % (dirName, fileName)] = {"sha256": sha256, "size": cbFile}
+        else:
+            if os.path.exists(destFileName) and os.stat(destFileName).st_nlink > 1:
+                # an earlier --store extraction; don't write through into the blob
+                os.remove(destFileName)
+            f = open(destFileName, "wb")
+            try:
+                written = WriteExtents(vol.data, extents, cbFile, f)
+            finally:
+                f.close()
+            size = written
+        with printLock:
             print("Creating %s" % destFileName)
-            open(destFileName, "w").write(contents)
+        return (size, written)
+
+    startTime = time.time()
+    pool = ThreadPool(max(1, args.jobs))
+    try:
+        results = list(pool.imap_unordered(extractOne, plan))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - startTime, 0.000001)
+    totalBytes = sum([size for (size, written) in results])
+    writtenBytes = sum([written for (size, written) in results])
+
+    print("Extracted %d files, %d bytes in %0.2f seconds (%0.1f KB/s)" % (len(plan), totalBytes, elapsed, totalBytes / elapsed / 1024.0), file=sys.stderr)
+
+    if args.store:
+        manifestFileName = writeManifest(args.store, args.imagefilename, manifest)
+        print("Stored %d bytes new to the store; manifest %s" % (writtenBytes, manifestFileName), file=sys.stderr)
+
+def blobFileName(storeDir, sha256):
+    return os.path.join(storeDir, "objects", sha256[:2], sha256)
+
+def storeBlob(storeDir, data, extents, cbFile):
+    """ Put the data in a list of extents into the store, unless it's there
+        already. Returns (sha256, size, bytes written).
+    """
+    sha256 = HashExtents(data, extents, cbFile)
+    size = sum([len(chunk) for chunk in IterExtents(data, extents, cbFile)])
+    blobFn = blobFileName(storeDir, sha256)
+    if os.path.exists(blobFn):
+        return (sha256, size, 0)
+
+    blobDir = os.path.dirname(blobFn)
+    try:
+        os.makedirs(blobDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Write under a temporary name and rename, so a blob is never seen half
+    # written, even with several extractions into the same store at once.
+    (fd, tempFn) = tempfile.mkstemp(dir=blobDir)
+    f = os.fdopen(fd, "wb")
+    try:
+        written = WriteExtents(data, extents, cbFile, f)
+    finally:
+        f.close()
+    # blobs are shared by every file linked to them, so nobody may edit one
+    os.chmod(tempFn, 0o444)
+    try:
+        os.rename(tempFn, blobFn)
+    except OSError:
+        # someone else stored the same contents first
+        os.chmod(tempFn, 0o644)
+        os.remove(tempFn)
+        if not os.path.exists(blobFn):
+            raise
+        written = 0
+    return (sha256, size, written)
+
+def linkOrCopy(src, dest):
+    # Replace, rather than write through, anything already at dest: it may
+    # itself be a link to a blob.
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except (AttributeError, OSError):
+        # no hardlinks on this platform, or the store is on another device
+        shutil.copyfile(src, dest)
+
+def writeManifest(storeDir, imageFileName, manifest):
+    """ Record which blob each of an image's files is, in
+        <store>/manifests/<image name>-<hash of its path>.json
+    """
+    imagePath = os.path.abspath(imageFileName)
+    manifestDir = os.path.join(storeDir, "manifests")
+    if not os.path.exists(manifestDir):
+        os.makedirs(manifestDir)
+    manifestFileName = os.path.join(manifestDir, "%s-%s.json" % (os.path.basename(imagePath), hashlib.sha1(imagePath).hexdigest()[:8]))
+    f = open(manifestFileName, "w")
+    try:
+        json.dump({"image": imagePath, "files": manifest}, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    return manifestFileName
+
+def hashFiles(args):
+    vol = loadVolume(args)
+
+    if args.args:
+        dirNames = args.args
+        for dirName in dirNames:
+            if vol.FindDir(dirName) is None:
+                print("Error: Dir Not Found: %s" % dirName, file=sys.stderr)
+                sys.exit(-1)
+    else:
+        dirNames = [mfdEntry["dirNameStr"] for mfdEntry in vol.mfd]
+
+    out = getOutputFile(args)
+    for dirName in dirNames:
+        for dirEntry in vol.ReadDir(dirName):
+            fh = dirEntry.fh
+            if fh is None:
+                continue
+            out.write("%s  %s/%s\n" % (HashContents(vol.data, fh), dirName, dirEntry["name"]))
 
 def stat(args):
     if len(args.args)<2:
         print("Error: required argument <directory> and <filename> are missing", file=sys.stderr)
         sys.exit(-1)
 
-    data = loadFile(args)
-    fh = openFile(data, args.args[0], args.args[1])
+    vol = loadVolume(args)
+    fh = openFile(vol, args.args[0], args.args[1])
 
     for k, v in fh.items():
         if k in ["sbFileName", "AppSpecific", "rgcbExtents", "rgLfaExtents"]:
@@ -275,24 +564,289 @@ def setgeometry(args):
     sectors = int(args.args[2])
     bytesPerSector = int(args.args[3])
 
-    data = loadFile(args)
+    vol = loadVolume(args, mutable=True)
+    data = vol.data
 
+    geometry = GeometryFields(cylinders, heads, sectors, bytesPerSector)
     for (vhbName,fldName) in [("active", "LfaVHB"), ("backup", "LfaInitialVHB")]:
-        vhb = LoadVHB(data, vhbName)
+        if vhbName == "active":
+            vhb = vol.vhb.copy()
+        else:
+            vhb = vol.backupVhb.copy()
         activeOffs = vhb[fldName]
-        vhb["BytesPerSector"] = bytesPerSector
-        vhb["SectorsPerTrack"] = sectors
-        vhb["TracksPerCylinder"] = heads
-        vhb["CylindersPerDisk"] = cylinders
-        data = EncodeStruct(vhb, data, VHB_FIELDS, activeOffs)
-        vhb["Checksum"] = ComputeVHBChecksum(data[activeOffs:])
-        data = EncodeStruct(vhb, data, VHB_FIELDS, activeOffs)
+        values = dict(geometry)
+        values.update(ChsFields(vhb, geometry))
+        for (name, value) in values.items():
+            vhb[name] = value
+        data = VHB_CODEC.pack_into(vhb, data, activeOffs)
+        vhb["Checksum"] = ComputeVHBChecksum(data, activeOffs)
+        data = VHB_CODEC.pack_into(vhb, data, activeOffs)
+        vol.MarkDirty(activeOffs)
+        vol.Invalidate()
 
         vhb_test = LoadVHB(data, vhbName)
         if vhb_test != vhb:
             print("Error: mismatch in re-encoded FHB", file=sys.stderr)
 
-    getOutputFile(args).write(data)
+    if args.inplace:
+        saveVolume(args, vol)
+    else:
+        getOutputFile(args).write(data)
+
+def compact(args):
+    if len(args.args)<4:
+        print("Error: required arguments <cylinders> <heads> <sectors> <bytesPerSector> are missing", file=sys.stderr)
+        sys.exit(-1)
+
+    cylinders = int(args.args[0])
+    heads = int(args.args[1])
+    sectors = int(args.args[2])
+    bytesPerSector = int(args.args[3])
+
+    vol = loadVolume(args)
+    newData = Compact(vol, cylinders, heads, sectors, bytesPerSector)
+
+    newVol = CtosVolume(newData)
+    errors = CheckDisk(newVol)
+    if errors > 0:
+        print("Error: compacted volume has %d errors, not writing it" % errors, file=sys.stderr)
+        sys.exit(-1)
+
+    print("Compacted %d sectors in use into a %d byte image, %d sectors free" % (len(newData)//512 - newVol.bitmap.CountFree(), len(newData), newVol.bitmap.CountFree()), file=sys.stderr)
+
+    getOutputFile(args).write(newData)
+
+def convert(args):
+    if len(args.args)<4:
+        print("Error: required arguments <cylinders> <heads> <sectors> <bytesPerSector> are missing", file=sys.stderr)
+        sys.exit(-1)
+
+    cylinders = int(args.args[0])
+    heads = int(args.args[1])
+    sectors = int(args.args[2])
+    bytesPerSector = int(args.args[3])
+
+    vol = loadVolume(args)
+    if args.output == "":
+        written = Convert(vol, sys.stdout, cylinders, heads, sectors, bytesPerSector, interleave=args.interleave)
+    else:
+        # Convert to a temporary file and rename it over the output only once
+        # it is complete and checked, so a geometry Convert rejects, or a
+        # failed check, leaves whatever was there before untouched.
+        tempFn = args.output + ".tmp"
+        try:
+            out = open(tempFn, "wb")
+            try:
+                written = Convert(vol, out, cylinders, heads, sectors, bytesPerSector, interleave=args.interleave)
+            finally:
+                out.close()
+            # a track-ordered image isn't in LFA order any more, so can't be checked
+            if args.interleave is None:
+                errors = CheckDisk(CtosVolume(OpenImage(tempFn)))
+                if errors > 0:
+                    print("Error: converted volume has %d errors" % errors, file=sys.stderr)
+                    sys.exit(-1)
+            if os.path.exists(args.output):
+                # rename won't replace an existing file on Windows
+                os.remove(args.output)
+            os.rename(tempFn, args.output)
+        finally:
+            if os.path.exists(tempFn):
+                os.remove(tempFn)
+
+    print("Converted to %d/%d/%d/%d, %d bytes" % (cylinders, heads, sectors, bytesPerSector, written), file=sys.stderr)
+
+def defrag(args):
+    vol = loadVolume(args, mutable=True)
+
+    (before, after, copied) = Defrag(vol, fullCheck=True)
+
+    print("Before: %d extents, seek distance %d sectors (%d cylinders)" % before)
+    print("After:  %d extents, seek distance %d sectors (%d cylinders)" % after)
+    print("%d sectors copied" % copied)
+
+    saveVolume(args, vol)
+
+def diff(args):
+    if len(args.args)<1:
+        print("Error: required argument <otherimage> is missing", file=sys.stderr)
+        sys.exit(-1)
+
+    vol1 = loadVolume(args)
+    vol2 = CtosVolume(OpenImage(args.args[0]))
+    DiffVolumes(vol1, vol2)
+
+CATALOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE NOT NULL,
+        size INTEGER,
+        mtime REAL,
+        error TEXT,
+        volName TEXT,
+        creationDT INTEGER,
+        modificationDT INTEGER,
+        cylinders INTEGER,
+        heads INTEGER,
+        sectors INTEGER,
+        bytesPerSector INTEGER,
+        freePages INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS dirs (
+        image INTEGER NOT NULL,
+        name TEXT,
+        lfa INTEGER,
+        pages INTEGER,
+        files INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        image INTEGER NOT NULL,
+        dir TEXT,
+        name TEXT,
+        fho INTEGER,
+        size INTEGER,
+        extents INTEGER,
+        creationDate INTEGER,
+        modificationDate INTEGER,
+        sha256 TEXT
+    );
+    CREATE INDEX IF NOT EXISTS dirs_image ON dirs (image);
+    CREATE INDEX IF NOT EXISTS files_image ON files (image);
+    CREATE INDEX IF NOT EXISTS files_name ON files (name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+
+def openCatalog(fn):
+    db = sqlite3.connect(fn)
+    # CTOS names are bytes in no particular encoding; store them as they are
+    db.text_factory = str
+    db.executescript(CATALOG_SCHEMA)
+    return db
+
+def findImages(paths):
+    """ Every file named in paths, and every file in the directory trees
+        named in paths, as (path, size, mtime)
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirPath, dirNames, fileNames) in os.walk(path):
+                dirNames.sort()
+                for fileName in sorted(fileNames):
+                    fn = os.path.join(dirPath, fileName)
+                    if os.path.isfile(fn):
+                        st = os.stat(fn)
+                        yield (os.path.abspath(fn), st.st_size, st.st_mtime)
+        elif os.path.isfile(path):
+            st = os.stat(path)
+            yield (os.path.abspath(path), st.st_size, st.st_mtime)
+        else:
+            print("Error: %s not found" % path, file=sys.stderr)
+
+def catalogImage(item):
+    """ Read one image in a worker process and return everything catalog
+        stores about it. Runs in a process pool, so it takes and returns
+        plain tuples and dicts.
+    """
+    (fn, size, mtime) = item
+    result = {"path": fn, "size": size, "mtime": mtime, "error": None, "dirs": [], "files": []}
+    try:
+        data = OpenImage(fn)
+        if not IsCtosVolume(data):
+            result["error"] = "not a CTOS volume"
+            return result
+
+        vol = CtosVolume(data)
+        vhb = vol.vhb
+        nameLen = ord(vhb["VolName"][0])
+        result["volName"] = vhb["VolName"][1:nameLen+1]
+        for k in ["CreationDT", "ModificationDT", "CylindersPerDisk", "TracksPerCylinder", "SectorsPerTrack", "BytesPerSector", "CFreePages"]:
+            result[k] = vhb[k]
+
+        for mfdEntry in vol.mfd:
+            dirName = mfdEntry["dirNameStr"]
+            dirEntries = vol.ReadDir(dirName)
+            result["dirs"].append( (dirName, mfdEntry["LfaDirbase"], mfdEntry["CPages"], len(dirEntries)) )
+            for dirEntry in dirEntries:
+                fh = dirEntry.fh
+                if fh is None:
+                    continue
+                result["files"].append( (dirName, dirEntry["name"], fh["fho"], fh["cbFile"], len(fh["extents"]),
+                                         fh["CreationDate"], fh["ModificationDate"], HashContents(data, fh)) )
+    except (Exception, SystemExit) as e:
+        # a damaged image shouldn't take the whole catalog down with it
+        result["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return result
+
+def storeImage(db, result):
+    cur = db.cursor()
+    for row in cur.execute("SELECT id FROM images WHERE path=?", (result["path"],)).fetchall():
+        cur.execute("DELETE FROM dirs WHERE image=?", row)
+        cur.execute("DELETE FROM files WHERE image=?", row)
+        cur.execute("DELETE FROM images WHERE id=?", row)
+
+    cur.execute("INSERT INTO images (path, size, mtime, error, volName, creationDT, modificationDT, cylinders, heads, sectors, bytesPerSector, freePages) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                (result["path"], result["size"], result["mtime"], result["error"], result.get("volName"),
+                 result.get("CreationDT"), result.get("ModificationDT"), result.get("CylindersPerDisk"),
+                 result.get("TracksPerCylinder"), result.get("SectorsPerTrack"), result.get("BytesPerSector"),
+                 result.get("CFreePages")))
+    imageId = cur.lastrowid
+    cur.executemany("INSERT INTO dirs (image, name, lfa, pages, files) VALUES (?,?,?,?,?)",
+                    [(imageId,) + d for d in result["dirs"]])
+    cur.executemany("INSERT INTO files (image, dir, name, fho, size, extents, creationDate, modificationDate, sha256) VALUES (?,?,?,?,?,?,?,?,?)",
+                    [(imageId,) + f for f in result["files"]])
+    db.commit()
+
+def catalog(args):
+    if len(args.args)<1:
+        print("Error: required argument <image or directory> is missing", file=sys.stderr)
+        sys.exit(-1)
+
+    db = openCatalog(args.imagefilename)
+
+    # Images already cataloged at the same size and modification time are
+    # skipped, so an interrupted or repeated catalog only reads what's new.
+    known = dict([(path, (size, mtime)) for (path, size, mtime) in db.execute("SELECT path, size, mtime FROM images")])
+    found = list(findImages(args.args))
+    todo = [item for item in found if known.get(item[0]) != (item[1], item[2])]
+
+    startTime = time.time()
+    counts = {"images": 0, "files": 0, "skipped": 0}
+    pool = Pool(max(1, args.jobs))
+    try:
+        # rows are written as each image finishes, one transaction per image
+        for result in pool.imap_unordered(catalogImage, todo):
+            storeImage(db, result)
+            if result["error"]:
+                counts["skipped"] += 1
+                print("Skipping %s: %s" % (result["path"], result["error"]), file=sys.stderr)
+            else:
+                counts["images"] += 1
+                counts["files"] += len(result["files"])
+                print("Cataloged %s, %d files" % (result["path"], len(result["files"])))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - startTime, 0.000001)
+
+    db.close()
+
+    print("Cataloged %d images, %d files in %0.2f seconds; %d skipped, %d unchanged" % (counts["images"], counts["files"], elapsed, counts["skipped"], len(found) - len(todo)), file=sys.stderr)
+
+def find(args):
+    if len(args.args)<1:
+        print("Error: required argument <filename or sha256> is missing", file=sys.stderr)
+        sys.exit(-1)
+
+    db = openCatalog(args.imagefilename)
+    for arg in args.args:
+        if re.match("^[0-9a-fA-F]{64}$", arg):
+            query = "SELECT images.path, files.dir, files.name, files.size, files.sha256 FROM files JOIN images ON images.id=files.image WHERE files.sha256=? ORDER BY images.path, files.dir, files.name"
+            arg = arg.lower()
+        else:
+            query = "SELECT images.path, files.dir, files.name, files.size, files.sha256 FROM files JOIN images ON images.id=files.image WHERE files.name=? COLLATE NOCASE ORDER BY images.path, files.dir, files.name"
+        for (path, dirName, fileName, size, sha256) in db.execute(query, (arg,)):
+            print("%s %s %s %d %s" % (path, dirName, fileName, size, sha256))
+    db.close()
 
 def main():
     SanityCheckAll()
@@ -322,6 +876,22 @@ def main():
         chkdsk(args)
     elif args.command == "delete":
         delete(args)
+    elif args.command == "batch":
+        batch(args)
+    elif args.command == "compact":
+        compact(args)
+    elif args.command == "convert":
+        convert(args)
+    elif args.command == "defrag":
+        defrag(args)
+    elif args.command == "hash":
+        hashFiles(args)
+    elif args.command == "diff":
+        diff(args)
+    elif args.command == "catalog":
+        catalog(args)
+    elif args.command == "find":
+        find(args)
     else:
         print("Unrecognized command: %s" % args.command, file=sys.stderr)
 
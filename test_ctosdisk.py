@@ -0,0 +1,59 @@
+""" test_ctosdisk.py
+
+    Run with "python -m unittest test_ctosdisk" (or pytest).
+"""
+
+import unittest
+
+from ctosdisk import AllocationBitmap, ExtentAllocator
+
+def makeVhb(cursor, skip=0, clusterFactor=1):
+    return {"ClusterFactor": clusterFactor,
+            "AllocSkipCnt": skip,
+            "LastAllocBitMapPage": cursor // (512 * 8),
+            "LastAllocWord": (cursor % (512 * 8)) // 16,
+            "LastAllocBit": cursor % 16}
+
+def freeBitmap(nSectors):
+    return AllocationBitmap(b"\xff" * (nSectors // 8), nSectors)
+
+class ExtentAllocatorTest(unittest.TestCase):
+    def testStartsAtCursorInsideRun(self):
+        bitmap = freeBitmap(64)
+        allocator = ExtentAllocator(bitmap, makeVhb(10))
+        self.assertEqual(allocator.Allocate(5), [(10, 5)])
+        # the sectors before the cursor are still free, and still a run
+        self.assertEqual(list(bitmap.FreeRuns()), [(0, 10), (15, 49)])
+        self.assertEqual(allocator.runs, [[0, 10], [15, 49]])
+
+    def testLeavesSkipGap(self):
+        bitmap = freeBitmap(64)
+        allocator = ExtentAllocator(bitmap, makeVhb(10, skip=2))
+        self.assertEqual([allocator.Allocate(5) for i in range(3)],
+                         [[(10, 5)], [(17, 5)], [(24, 5)]])
+        for sector in (15, 16, 22, 23):
+            self.assertEqual(bitmap[sector], 1)
+        self.assertEqual(allocator.CursorFields(), {"LastAllocBitMapPage": 0, "LastAllocWord": 1, "LastAllocBit": 15})
+
+    def testWrapsAround(self):
+        bitmap = freeBitmap(64)
+        allocator = ExtentAllocator(bitmap, makeVhb(60))
+        self.assertEqual(allocator.Allocate(8), [(0, 8)])
+        self.assertEqual(list(bitmap.FreeRuns()), [(8, 56)])
+
+    def testFullDisk(self):
+        bitmap = AllocationBitmap(b"\x00" * 8, 64)
+        allocator = ExtentAllocator(bitmap, makeVhb(10))
+        self.assertEqual(allocator.runs, [])
+        self.assertEqual(allocator.Allocate(1), None)
+
+    def testFillsDisk(self):
+        bitmap = freeBitmap(64)
+        allocator = ExtentAllocator(bitmap, makeVhb(10))
+        self.assertEqual(allocator.Allocate(64), [(0, 64)])
+        self.assertEqual(allocator.runs, [])
+        self.assertEqual(allocator.Allocate(1), None)
+        self.assertEqual(list(bitmap.FreeRuns()), [])
+
+if __name__ == "__main__":
+    unittest.main()